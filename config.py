@@ -1,4 +1,5 @@
 import os
+import time
 import database
 import logging
 
@@ -30,17 +31,23 @@ class Config:
         "logging.file": "tg_downloader.log",
         "logging.headless": False,
         "logging.log_interval": 30,
+        "logging.refresh_interval": 1.0,
         
         "system.setup_completed": False
     }
     
     # 当前内存配置
     _settings = {}
+    # to_dict() 的缓存副本，配置重载时清空
+    _cached_dict = None
+    # 本进程内已确认存在的目录
+    _dirs_ensured = set()
     
     # 类属性占位符 (防止 IDE 报错)
     API_ID = 2040
     API_HASH = ""
     SESSION_NAME = ""
+    SESSION_FILE = ""
     DOWNLOAD_DIR = ""
     TEMP_DIR = ""
     USE_PROXY = False
@@ -56,67 +63,91 @@ class Config:
     LOG_FILE = "tg_downloader.log"
     HEADLESS = False
     LOG_INTERVAL = 30
+    REFRESH_INTERVAL = 1.0  # 终端进度面板刷新间隔 (秒)
 
     # 静态常量
     CHUNK_SIZE = 1024 * 1024
+    # Telethon 单次 GetFile 请求大小: 须为 4KB 的倍数且不超过 512KB (超出会被截断，
+    # 且与 chunk_size 不一致时退回较慢的重组下载路径)
+    REQUEST_SIZE = 512 * 1024
     PART_SIZE = 10 * 1024 * 1024
     MAX_RETRIES = 50
     RETRY_DELAY_BASE = 5
     RETRY_DELAY_MAX = 60
     LOG_LEVEL = "INFO"
+    SESSION_CHECK_TTL = 1.0  # Session 文件存在性检查的缓存时间 (秒)
+
+    # Session 存在性缓存: (检查时间, 是否存在)
+    _session_check = (float("-inf"), False)
 
     @classmethod
     def load(cls):
         """从数据库加载配置"""
         db_settings = database.load_settings_sync()
-        cls._settings = cls.DEFAULTS.copy()
+        settings = cls.DEFAULTS.copy()
         # Merge DB settings
-        cls._settings.update(db_settings)
+        settings.update(db_settings)
         
-        # 刷新属性
-        cls.API_ID = int(cls.get("telegram.api_id"))
-        cls.API_HASH = cls.get("telegram.api_hash")
+        # 配置未变化时跳过属性刷新
+        if settings == cls._settings:
+            return
+        g = settings.get
+        
+        # 先计算出全部属性，全部成功后再一次性替换
+        # (某个值非法时不会留下新旧混杂的配置)
+        values = {}
+        values["API_ID"] = int(g("telegram.api_id"))
+        values["API_HASH"] = g("telegram.api_hash")
         
         # 确保 Session 文件保存在 data 目录
-        data_dir = cls.get("directories.data_dir", "data")
-        session_base = cls.get("telegram.session_name", "telethon_session")
+        data_dir = g("directories.data_dir", "data")
+        session_base = g("telegram.session_name", "telethon_session")
         if not os.path.isabs(session_base):
-            cls.SESSION_NAME = os.path.join(data_dir, session_base)
+            values["SESSION_NAME"] = os.path.join(data_dir, session_base)
         else:
-            cls.SESSION_NAME = session_base
+            values["SESSION_NAME"] = session_base
+        values["SESSION_FILE"] = f"{values['SESSION_NAME']}.session"
         
-        cls.DOWNLOAD_DIR = cls.get("directories.download_dir")
+        values["DOWNLOAD_DIR"] = g("directories.download_dir")
         
         # 优先使用用户配置的临时目录，提升 IO 性能
-        custom_temp = cls.get("directories.temp_dir")
+        custom_temp = g("directories.temp_dir")
         if custom_temp and custom_temp.strip():
-            cls.TEMP_DIR = custom_temp
+            values["TEMP_DIR"] = custom_temp
         else:
             # 用户要求直接使用项目根目录作为默认临时目录
-            cls.TEMP_DIR = "." # Current directory
-        
-        cls.USE_PROXY = cls.get("proxy.enable")
-        if cls.USE_PROXY:
-            cls.PROXY = {
-                "scheme": cls.get("proxy.scheme"),
-                "hostname": cls.get("proxy.host"),
-                "port": int(cls.get("proxy.port"))
+            values["TEMP_DIR"] = "." # Current directory
+        
+        values["USE_PROXY"] = g("proxy.enable")
+        if values["USE_PROXY"]:
+            values["PROXY"] = {
+                "scheme": g("proxy.scheme"),
+                "hostname": g("proxy.host"),
+                "port": int(g("proxy.port"))
             }
         else:
-            cls.PROXY = None
+            values["PROXY"] = None
 
-        cls.MAX_WORKERS = int(cls.get("download.max_workers"))
-        cls.WORKER_COUNT = int(cls.get("download.worker_count"))
+        values["MAX_WORKERS"] = int(g("download.max_workers"))
+        values["WORKER_COUNT"] = int(g("download.worker_count"))
         
-        cls.DASHBOARD_HOST = cls.get("dashboard.host")
-        cls.DASHBOARD_PORT = int(cls.get("dashboard.port"))
-        cls.ENABLE_DASHBOARD = cls.get("dashboard.enable", True)
+        values["DASHBOARD_HOST"] = g("dashboard.host")
+        values["DASHBOARD_PORT"] = int(g("dashboard.port"))
+        values["ENABLE_DASHBOARD"] = g("dashboard.enable", True)
         
-        cls.LOG_FILE = cls.get("logging.file", "tg_downloader.log")
-        cls.HEADLESS = cls.get("logging.headless", False)
-        cls.LOG_INTERVAL = int(cls.get("logging.log_interval", 30))
+        values["LOG_FILE"] = g("logging.file", "tg_downloader.log")
+        values["HEADLESS"] = g("logging.headless", False)
+        values["LOG_INTERVAL"] = int(g("logging.log_interval", 30))
+        values["REFRESH_INTERVAL"] = float(g("logging.refresh_interval", 1.0))
         
-        cls.SETUP_COMPLETED = cls.get("system.setup_completed", False)
+        values["SETUP_COMPLETED"] = g("system.setup_completed", False)
+        
+        # 刷新属性
+        for name, value in values.items():
+            setattr(cls, name, value)
+        cls._settings = settings
+        cls._cached_dict = None
+        cls.invalidate_session_cache()
         
         # 确保目录存在 (只在 Setup 完成后或目录已配置时尝试)
         if cls.SETUP_COMPLETED or os.path.isabs(cls.DOWNLOAD_DIR):
@@ -130,41 +161,48 @@ class Config:
 
     @classmethod
     def to_dict(cls):
-        """返回当前所有配置的字典备份"""
-        return cls._settings.copy()
+        """返回当前所有配置的字典备份 (重载前复用同一份副本，调用方不应修改)"""
+        if cls._cached_dict is None:
+            cls._cached_dict = cls._settings.copy()
+        return cls._cached_dict
 
     @classmethod
-    def reload(cls):
-        cls.load()
+    def session_exists(cls):
+        """检查 Session 文件是否存在 (短时间内复用上次结果，避免每个请求都 stat)"""
+        now = time.monotonic()
+        checked_at, exists = cls._session_check
+        if now - checked_at < cls.SESSION_CHECK_TTL:
+            return exists
+        exists = os.path.exists(cls.SESSION_FILE)
+        cls._session_check = (now, exists)
+        return exists
 
     @classmethod
-    def get_progress_file_path(cls, message_id, chat_id):
-        """获取任务进度文件路径"""
-        filename = f"task_{chat_id}_{message_id}.json"
-        return os.path.join(cls.TEMP_DIR, filename)
+    def invalidate_session_cache(cls):
+        """Session 文件被创建或删除后调用，强制下次重新检查"""
+        cls._session_check = (float("-inf"), False)
 
     @classmethod
-    def ensure_directories(cls):
-        """确保必要的目录存在"""
-        if cls.DOWNLOAD_DIR and not os.path.exists(cls.DOWNLOAD_DIR):
-            try:
-                os.makedirs(cls.DOWNLOAD_DIR, exist_ok=True)
-            except Exception as e:
-                print(f"创建下载目录失败: {e}")
-                
-        if cls.TEMP_DIR and not os.path.exists(cls.TEMP_DIR):
-            try:
-                os.makedirs(cls.TEMP_DIR, exist_ok=True)
-            except Exception as e:
-                print(f"创建临时目录失败: {e}")
+    def reload(cls):
+        cls.load()
 
-        # 确保数据目录存在
-        data_dir = cls.get("directories.data_dir", "data")
-        if data_dir and not os.path.exists(data_dir):
+    @classmethod
+    def ensure_directories(cls):
+        """确保必要的目录存在 (同一目录在进程内只处理一次)"""
+        dirs = (
+            (cls.DOWNLOAD_DIR, "下载"),
+            (cls.TEMP_DIR, "临时"),
+            # 确保数据目录存在
+            (cls.get("directories.data_dir", "data"), "数据"),
+        )
+        for path, label in dirs:
+            if not path or path in cls._dirs_ensured:
+                continue
             try:
-                os.makedirs(data_dir, exist_ok=True)
+                os.makedirs(path, exist_ok=True)
+                cls._dirs_ensured.add(path)
             except Exception as e:
-                print(f"创建数据目录失败: {e}")
+                print(f"创建{label}目录失败: {e}")
 
 # 模块加载时自动执行一次配置加载
 Config.load()
@@ -1,9 +1,11 @@
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import HTMLResponse, JSONResponse
 from pydantic import BaseModel
 import os
+import time
+import traceback
 import uvicorn
 import asyncio
 import psutil
@@ -11,9 +13,6 @@ from collections import deque
 from config import Config
 import logging
 import database
-import yaml
-from telethon import TelegramClient, errors
-from telethon.errors import SessionPasswordNeededError
 
 # Pydantic 请求模型
 class CodeRequest(BaseModel):
@@ -30,16 +29,42 @@ logger = logging.getLogger("Dashboard")
 class MemoryLogHandler(logging.Handler):
     def __init__(self, capacity=50):
         super().__init__()
-        self.logs = deque(maxlen=capacity)
-        self.formatter = logging.Formatter('%(asctime)s | %(levelname)-7s | %(message)s', datefmt='%H:%M:%S')
+        self.logs = deque(maxlen=capacity)  # (序号, 日志文本)
+        self.seq = 0
+        # 时间戳按秒缓存，同一秒内的日志复用格式化结果
+        self._last_ts = 0
+        self._last_asc = ""
 
     def emit(self, record):
         try:
-            msg = self.format(record)
-            self.logs.append(msg)
+            t = int(record.created)
+            if t != self._last_ts:
+                self._last_asc = time.strftime("%H:%M:%S", time.localtime(t))
+                self._last_ts = t
+            msg = f"{self._last_asc} | {record.levelname:<7} | {record.getMessage()}"
+            if record.exc_info:
+                msg += "\n" + "".join(traceback.format_exception(*record.exc_info)).rstrip()
+            self.seq += 1
+            self.logs.append((self.seq, msg))
+            notify_ws()
         except Exception:
             self.handleError(record)
 
+    def since(self, cursor):
+        """返回序号大于 cursor 的日志 (按时间顺序)，从尾部往前只扫描新增部分"""
+        newer = []
+        with self.lock:
+            # 游标比当前序号还大说明服务端已重启，返回全部日志
+            if cursor > self.seq:
+                cursor = 0
+            for seq, msg in reversed(self.logs):
+                if seq <= cursor:
+                    break
+                newer.append(msg)
+            current = self.seq
+        newer.reverse()
+        return newer, current
+
 # 全局日志收集器
 mem_handler = MemoryLogHandler()
 logging.getLogger().addHandler(mem_handler)
@@ -72,6 +97,19 @@ templates_dir = os.path.join(os.path.dirname(__file__), "templates")
 os.makedirs(templates_dir, exist_ok=True)
 templates = Jinja2Templates(directory=templates_dir)
 
+# 页面渲染缓存: index/login 没有动态数据，setup 只依赖配置快照
+# Config.to_dict() 在重载前返回同一个对象，以此判断缓存是否过期
+_page_cache = {}
+
+def _cached_page(name, defaults=None):
+    """返回渲染好的页面，配置未变时直接复用上次结果"""
+    cached = _page_cache.get(name)
+    if cached is None or cached[0] is not defaults:
+        html = templates.get_template(name).render(defaults=defaults)
+        cached = (defaults, html)
+        _page_cache[name] = cached
+    return HTMLResponse(cached[1])
+
 # 全局 Downloader 引用
 downloader_instance = None
 
@@ -86,31 +124,36 @@ async def read_root(request: Request):
     if not Config.SETUP_COMPLETED:
         conf = Config.to_dict()
         logger.info(f"🔍 正在渲染 setup.html, 默认下载目录: {conf.get('directories.download_dir')}")
-        return templates.TemplateResponse("setup.html", {"request": request, "defaults": conf})
+        return _cached_page("setup.html", conf)
     
     # 状态 2: 已初始化但未登录
-    session_file = f"{Config.SESSION_NAME}.session"
-    if not os.path.exists(session_file):
-        return templates.TemplateResponse("login.html", {"request": request})
+    if not Config.session_exists():
+        return _cached_page("login.html")
     
     # 状态 3: 正常进入主页
-    return templates.TemplateResponse("index.html", {"request": request})
+    return _cached_page("index.html")
 
 @app.get("/setup.html", response_class=HTMLResponse)
 async def setup_page(request: Request):
     """系统配置页面"""
     conf = Config.to_dict()
     logger.info(f"🔍 访问 setup_page, 注入数据: {conf.get('directories.download_dir')}")
-    return templates.TemplateResponse("setup.html", {"request": request, "defaults": conf})
+    return _cached_page("setup.html", conf)
 
 @app.get("/login.html", response_class=HTMLResponse)
 async def login_page(request: Request):
     """Telegram 登录页面"""
-    return templates.TemplateResponse("login.html", {"request": request})
+    return _cached_page("login.html")
 
-@app.get("/api/system")
-async def get_system_stats():
-    """获取系统状态"""
+# 系统状态由后台任务每秒采样一次 (仅在有客户端查看时)，接口直接返回最近一次结果
+SYSTEM_SAMPLE_INTERVAL = 1.0
+# 超过这么久 (秒) 没有客户端请求系统状态就暂停采样
+SYSTEM_IDLE_TIMEOUT = 10.0
+_system_stats = None
+_system_last_request = 0.0
+
+def _collect_system_stats():
+    """采集 CPU / 内存 / 磁盘状态"""
     cpu_percent = psutil.cpu_percent(interval=None)
     mem = psutil.virtual_memory()
     
@@ -133,10 +176,36 @@ async def get_system_stats():
         "disk_free_gb": disk_free
     }
 
+async def _system_sampler():
+    """后台采样: cpu_percent(interval=None) 需要与上次调用间隔足够长才准确；无人查看时暂停"""
+    global _system_stats
+    await asyncio.to_thread(psutil.cpu_percent, None)  # 预热，建立基准
+    while True:
+        await asyncio.sleep(SYSTEM_SAMPLE_INTERVAL)
+        if time.monotonic() - _system_last_request > SYSTEM_IDLE_TIMEOUT:
+            _system_stats = None  # 暂停期间不再更新，旧结果作废
+            continue
+        try:
+            # psutil 读取 /proc 与 statvfs 都是阻塞调用，放到线程中
+            _system_stats = await asyncio.to_thread(_collect_system_stats)
+        except Exception as e:
+            logger.debug(f"系统状态采样失败: {e}")
+
+@app.get("/api/system")
+async def get_system_stats():
+    """获取系统状态"""
+    global _system_last_request
+    _system_last_request = time.monotonic()
+    if _system_stats is None:
+        # 采样任务尚未产出结果 (或刚从暂停中恢复)
+        return await asyncio.to_thread(_collect_system_stats)
+    return _system_stats
+
 @app.get("/api/logs")
-async def get_logs():
-    """获取最近日志"""
-    return {"logs": list(mem_handler.logs)}
+async def get_logs(since: int = 0):
+    """获取最近日志 (只返回序号大于 since 的新日志)"""
+    logs, cursor = mem_handler.since(since)
+    return {"logs": logs, "cursor": cursor}
 
 @app.get("/api/setup/status")
 async def get_setup_status():
@@ -147,9 +216,8 @@ async def complete_setup(request: Request):
     """完成初始化"""
     try:
         data = await request.json()
-        for key, value in data.items():
-            await database.update_setting(key, value)
-        await database.update_setting("system.setup_completed", True)
+        data["system.setup_completed"] = True
+        await database.update_settings_bulk(data)
         Config.reload()
         return {"status": "ok"}
     except Exception as e:
@@ -168,8 +236,10 @@ async def update_config_json(request: Request):
     """更新配置 (JSON)"""
     try:
         data = await request.json()
-        for key, value in data.items():
-            await database.update_setting(key, value)
+        # 与当前配置相同的提交无需写库和重载
+        if all(Config.get(key) == value for key, value in data.items()):
+            return {"status": "ok", "message": "Unchanged"}
+        await database.update_settings_bulk(data)
         Config.reload()
         return {"status": "ok", "message": "Updated"}
     except Exception as e:
@@ -185,6 +255,7 @@ async def cancel_task():
         
     if downloader:
         if await downloader.cancel_current_task():
+            invalidate_status_cache()
             return {"status": "ok", "message": "Task cancellation requested"}
             
     return JSONResponse(status_code=400, content={"status": "error", "message": "No active task"})
@@ -198,6 +269,7 @@ async def resume_task(message_id: int):
         
     if downloader:
         if await downloader.resume_task(message_id):
+            invalidate_status_cache()
             return {"status": "ok", "message": "Task resumed"}
             
     return JSONResponse(status_code=400, content={"status": "error", "message": "Failed to resume task"})
@@ -211,6 +283,7 @@ async def delete_cancelled_task(message_id: int):
         
     if downloader:
         if await downloader.delete_task(message_id):
+            invalidate_status_cache()
             return {"status": "ok", "message": "Task files cleaned up"}
             
     return JSONResponse(status_code=400, content={"status": "error", "message": "Failed to delete task or file not found"})
@@ -233,8 +306,8 @@ async def restart_bot():
 async def telegram_status():
     """检查 Telegram Session 状态"""
     main = _get_main()
-    session_file = f"{Config.SESSION_NAME}.session"
-    session_exists = os.path.exists(session_file)
+    session_file = Config.SESSION_FILE
+    session_exists = Config.session_exists()
     
     # 检查 Client 是否真正连接且授权
     logged_in = False
@@ -259,7 +332,7 @@ async def telegram_status():
 @app.get("/api/bot/status")
 async def bot_status():
     """获取 Bot 运行状态"""
-    session_exists = os.path.exists(f"{Config.SESSION_NAME}.session")
+    session_exists = Config.session_exists()
     
     # 使用传递的 main 模块引用获取状态
     client_connected = False
@@ -281,8 +354,7 @@ async def bot_status():
 @app.post("/api/bot/start")
 async def start_bot_manually():
     """手动启动 Telegram Bot"""
-    session_file = f"{Config.SESSION_NAME}.session"
-    if not os.path.exists(session_file):
+    if not Config.session_exists():
         return JSONResponse(status_code=400, content={"error": "请先完成 Telegram 登录"})
     
     try:
@@ -297,13 +369,21 @@ async def start_bot_manually():
         logger.error(f"启动 Bot 失败: {e}")
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+def _unlink_if_exists(path):
+    """删除文件，文件不存在时返回 False"""
+    try:
+        os.unlink(path)
+        return True
+    except FileNotFoundError:
+        return False
+
 @app.delete("/api/telegram/session")
 async def delete_session():
     """删除当前 Telegram Session（用于重新登录）"""
     main = _get_main()
     if not main:
         return JSONResponse(status_code=500, content={"error": "主模块未就绪"})
-    session_file = f"{Config.SESSION_NAME}.session"
+    session_file = Config.SESSION_FILE
     
     try:
         logger.info("🗑️ 开始删除 Session...")
@@ -314,24 +394,32 @@ async def delete_session():
         else:
             logger.info("ℹ️  Client 未初始化，直接删除文件")
         
-        # 2. 删除 Session 文件
-        if os.path.exists(session_file):
-            try:
-                os.remove(session_file)
-                logger.info(f"✅ 已删除 Session 文件: {session_file}")
-            except PermissionError:
-                # 如果仍然被占用，等待后重试
-                logger.warning("⚠️ 文件被占用，等待后重试...")
-                await asyncio.sleep(2)
-                os.remove(session_file)
+        # 2. 删除 Session 及 journal 文件 (放到线程中执行，避免阻塞事件循环)
+        journal_file = f"{session_file}-journal"
+        removed, journal_removed = await asyncio.gather(
+            asyncio.to_thread(_unlink_if_exists, session_file),
+            asyncio.to_thread(_unlink_if_exists, journal_file),
+            return_exceptions=True
+        )
+        if isinstance(removed, PermissionError):
+            # 如果仍然被占用，等待后重试
+            logger.warning("⚠️ 文件被占用，等待后重试...")
+            await asyncio.sleep(2)
+            removed = await asyncio.to_thread(_unlink_if_exists, session_file)
+            if removed:
                 logger.info(f"✅ 重试成功，已删除: {session_file}")
-            
-            # 3. 删除 journal 文件
-            journal_file = f"{session_file}-journal"
-            if os.path.exists(journal_file):
-                os.remove(journal_file)
-                logger.info(f"✅ 已删除 Journal 文件")
-            
+        elif isinstance(removed, Exception):
+            raise removed
+        elif removed:
+            logger.info(f"✅ 已删除 Session 文件: {session_file}")
+        
+        if isinstance(journal_removed, Exception):
+            raise journal_removed
+        if journal_removed:
+            logger.info(f"✅ 已删除 Journal 文件")
+        
+        Config.invalidate_session_cache()
+        if removed:
             return {"status": "ok", "message": "Session 已删除"}
         else:
             logger.info("ℹ️ Session 文件不存在")
@@ -380,6 +468,9 @@ async def sign_in(req: SignInRequest):
     if not main:
         return JSONResponse(status_code=500, content={"error": "主模块未就绪"})
     
+    # 仅登录流程需要，延迟导入避免拖慢 Dashboard 启动
+    from telethon.errors import SessionPasswordNeededError
+    
     phone = telegram_login_state.get("phone")
     phone_code_hash = telegram_login_state.get("phone_code_hash")
     client = telegram_login_state.get("client") or main.client
@@ -425,9 +516,30 @@ async def sign_in(req: SignInRequest):
         logger.error(f"登录失败: {e}")
         return JSONResponse(status_code=400, content={"error": str(e)})
 
+# /api/status 结果缓存 (前端每秒轮询，多个标签页共享同一份结果)
+STATUS_CACHE_TTL = 0.5
+_status_cache = {"ts": 0.0, "data": None}
+
+def invalidate_status_cache():
+    """任务状态被主动修改后调用 (取消/恢复/删除)"""
+    global _ws_status_rev
+    _status_cache["data"] = None
+    _ws_status_rev += 1
+    notify_ws()
+
 @app.get("/api/status")
 async def get_status():
     """获取最新状态 API"""
+    now = time.monotonic()
+    if _status_cache["data"] is not None and now - _status_cache["ts"] < STATUS_CACHE_TTL:
+        return _status_cache["data"]
+    data = await _build_status()
+    _status_cache["data"] = data
+    _status_cache["ts"] = now
+    return data
+
+async def _build_status():
+    """构造状态数据"""
     # 使用 main_module 获取 downloader
     downloader = None
     if hasattr(server, 'main_module'):
@@ -475,12 +587,13 @@ async def get_status():
     cancelled_data = []
     
     try:
-        if downloader:
-            cancelled_data = await downloader.get_cancelled_tasks()
-            
-        history = await database.get_recent_history(limit=10)
-        # 数据库返回的是字典列表: {'id':..., 'filename':..., 'size':...}
-        history_data = [{"filename": h['filename'], "size": h['size']} for h in history]
+        # 两个查询互不依赖，并发执行
+        cancelled_data, history = await asyncio.gather(
+            downloader.get_cancelled_tasks(),
+            database.get_recent_history(limit=10)
+        )
+        # 数据库返回 HistoryRow 命名元组 (按字段名访问 filename / size)
+        history_data = [{"filename": h.filename, "size": h.size} for h in history]
     except Exception as e:
         logger.error(f"读取状态失败: {e}")
     
@@ -494,6 +607,87 @@ async def get_status():
         "cancelled": cancelled_data
     }
 
+# WebSocket 推送: 有新日志时立即推送日志；状态只在被主动修改时立即刷新，
+# 否则下载中按间隔刷新进度与速度，空闲时只做低频兜底
+WS_PUSH_INTERVAL = 1.0
+WS_IDLE_INTERVAL = 10.0
+_ws_waiters = set()
+_ws_loop = None
+_ws_status_rev = 0  # invalidate_status_cache 每次调用 +1
+
+def _wake_ws():
+    """唤醒所有推送循环 (在事件循环线程中执行)"""
+    for event in _ws_waiters:
+        event.set()
+
+def notify_ws():
+    """通知 WebSocket 有新内容 (日志可能来自线程池，可在任意线程调用)"""
+    loop = _ws_loop
+    if _ws_waiters and loop is not None and not loop.is_closed():
+        loop.call_soon_threadsafe(_wake_ws)
+
+@app.websocket("/ws/status")
+async def ws_status(websocket: WebSocket, since: int = 0):
+    """推送任务状态与新日志，只在内容变化时发送 (HTTP 轮询接口保留作为回退)"""
+    global _ws_loop
+    await websocket.accept()
+    _ws_loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+    _ws_waiters.add(wakeup)
+    
+    async def wait_disconnect():
+        # 客户端不发送数据，receive 只用来及时感知断开
+        try:
+            while (await websocket.receive())["type"] != "websocket.disconnect":
+                pass
+        except Exception:
+            pass
+    
+    disconnected = asyncio.create_task(wait_disconnect())
+    last_status = None
+    status_rev = None
+    next_status_at = 0.0
+    cursor = since
+    try:
+        while not disconnected.done():
+            wakeup.clear()
+            message = {}
+            # 日志唤醒只推送日志，不重建状态 (构造状态时产生的日志不会再次触发重建)
+            if time.monotonic() >= next_status_at or status_rev != _ws_status_rev:
+                status_rev = _ws_status_rev
+                status = await get_status()
+                interval = WS_PUSH_INTERVAL if status.get("running") else WS_IDLE_INTERVAL
+                next_status_at = time.monotonic() + interval
+                if status != last_status:
+                    message["status"] = status
+                    last_status = status
+            
+            logs, new_cursor = mem_handler.since(cursor)
+            if logs or new_cursor != cursor:
+                message["logs"] = {"logs": logs, "cursor": new_cursor}
+                cursor = new_cursor
+            
+            if message:
+                await websocket.send_json(message)
+            
+            woken = asyncio.create_task(wakeup.wait())
+            timeout = max(0.0, next_status_at - time.monotonic())
+            await asyncio.wait([woken, disconnected], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            woken.cancel()
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logger.debug(f"WebSocket 推送结束: {e}")
+        try:
+            await websocket.close()
+        except Exception:
+            pass
+    finally:
+        _ws_waiters.discard(wakeup)
+        disconnected.cancel()
+
+_uvicorn_server = None
+
 async def run_server():
     """启动 uvicorn 服务"""
     config = uvicorn.Config(
@@ -502,6 +696,17 @@ async def run_server():
         port=Config.DASHBOARD_PORT, 
         log_level="warning"
     )
-    server = uvicorn.Server(config)
+    global _uvicorn_server
+    server = _uvicorn_server = uvicorn.Server(config)
+    sampler = asyncio.create_task(_system_sampler())
     logger.info(f"🌐 Dashboard 启动: http://{Config.DASHBOARD_HOST}:{Config.DASHBOARD_PORT}")
-    await server.serve()
+    try:
+        await server.serve()
+    finally:
+        sampler.cancel()
+        _uvicorn_server = None
+
+def stop_server():
+    """通知 uvicorn 优雅退出 (由 main 的退出流程调用)"""
+    if _uvicorn_server is not None:
+        _uvicorn_server.should_exit = True
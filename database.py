@@ -1,26 +1,108 @@
 import aiosqlite
 import sqlite3
+import asyncio
 import os
 import logging
 import json
+from collections import namedtuple
 from datetime import datetime
 
 logger = logging.getLogger("Database")
 
+# 任务进度序列化: 优先使用 orjson (C 实现)，未安装时回退到标准库
+try:
+    import orjson
+
+    def _dumps(obj):
+        return orjson.dumps(obj).decode()
+
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj, ensure_ascii=False)
+
+    _loads = json.loads
+
+# 历史记录行 (比逐行构造 dict 更省内存)
+HistoryRow = namedtuple("HistoryRow", "id filename size duration completed_at")
+
 # 数据库保存路径，优先保存到 data 目录以便 Docker 挂载
 DATA_DIR = "data"
-if not os.path.exists(DATA_DIR):
-    try:
-        os.makedirs(DATA_DIR, exist_ok=True)
-    except:
-        pass
+try:
+    # exist_ok 一次系统调用即可，无需先 exists 再创建
+    os.makedirs(DATA_DIR, exist_ok=True)
+    DB_PATH = os.path.join(DATA_DIR, "bot_data.db")
+except OSError:
+    DB_PATH = "bot_data.db"
 
-DB_PATH = os.path.join(DATA_DIR, "bot_data.db") if os.path.exists(DATA_DIR) else "bot_data.db"
+# 连接参数: WAL 使下载写进度与面板读历史互不阻塞，NORMAL 在 WAL 下仍保证一致性
+CONNECTION_PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA busy_timeout=5000;
+    PRAGMA cache_size=-20000;
+    PRAGMA temp_store=MEMORY;
+"""
+
+# 常用 SQL (固定字符串，配合连接的语句缓存复用已编译的语句)
+SQL_UPSERT_SETTING = "INSERT OR REPLACE INTO settings (key, value, description) VALUES (?, ?, ?)"
+SQL_INSERT_HISTORY = "INSERT INTO history (filename, size, duration, completed_at) VALUES (?, ?, ?, ?)"
+SQL_UPSERT_TASK = (
+    "INSERT OR REPLACE INTO active_tasks "
+    "(message_id, chat_id, file_name, file_size, status, data, updated_at) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+SQL_SELECT_TASK = "SELECT data FROM active_tasks WHERE message_id = ? AND chat_id = ?"
+SQL_DELETE_TASK = "DELETE FROM active_tasks WHERE message_id = ? AND chat_id = ?"
+STATEMENT_CACHE_SIZE = 128
+
+# 全局共享连接 (避免每次调用都新建连接线程、丢失页缓存)
+_db = None
+# close_db 之后不再重新连接，避免退出流程中迟到的写入重新打开数据库
+_closed = False
+# 锁在首次使用时创建，确保绑定到 asyncio.run 启动的事件循环
+_connect_lock = None
+_write_lock = None
+
+def _get_write_lock():
+    """写操作锁: execute + commit 作为一个整体，避免并发事务交错"""
+    global _write_lock
+    if _write_lock is None:
+        _write_lock = asyncio.Lock()
+    return _write_lock
+
+async def get_db():
+    """获取共享连接 (首次调用时建立)"""
+    global _db, _connect_lock
+    if _db is None:
+        if _closed:
+            raise RuntimeError("数据库已关闭")
+        if _connect_lock is None:
+            _connect_lock = asyncio.Lock()
+        async with _connect_lock:
+            if _db is None:
+                db = await aiosqlite.connect(DB_PATH, cached_statements=STATEMENT_CACHE_SIZE)
+                db.row_factory = aiosqlite.Row
+                await db.executescript(CONNECTION_PRAGMAS)
+                _db = db
+    return _db
+
+async def close_db():
+    """关闭共享连接 (程序退出时调用)"""
+    global _db, _closed
+    _closed = True
+    if _db is not None:
+        db, _db = _db, None
+        try:
+            await db.close()
+        except Exception as e:
+            logger.error(f"❌ 关闭数据库失败: {e}")
 
 async def init_db():
     """初始化数据库"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        db = await get_db()
+        async with _get_write_lock():
             # 1. 历史记录表
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS history (
@@ -45,6 +127,10 @@ async def init_db():
                     PRIMARY KEY (message_id, chat_id)
                 )
             """)
+            # 按状态列出任务 (已取消列表) 时走索引，并直接按更新时间排好序
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_active_tasks_status ON active_tasks (status, updated_at)"
+            )
 
             # 3. 系统配置表 (替代 config.yaml)
             await db.execute("""
@@ -62,6 +148,19 @@ async def init_db():
 
 # ==================== 配置管理 (Settings) ====================
 
+# 配置内存缓存 (key -> 解析后的值)，首次读取时整表加载，写入时同步更新
+_settings_cache = None
+
+def _decode_settings(rows):
+    """将 (key, json) 行解析为配置字典"""
+    settings = {}
+    for key, val_json in rows:
+        try:
+            settings[key] = json.loads(val_json)
+        except:
+            settings[key] = val_json
+    return settings
+
 def load_settings_sync():
     """同步加载所有配置 (用于程序启动时初始化 Config)"""
     if not os.path.exists(DB_PATH):
@@ -79,12 +178,9 @@ def load_settings_sync():
         rows = cursor.fetchall()
         conn.close()
         
-        settings = {}
-        for key, val_json in rows:
-            try:
-                settings[key] = json.loads(val_json)
-            except:
-                settings[key] = val_json
+        global _settings_cache
+        settings = _decode_settings(rows)
+        _settings_cache = settings.copy()
         return settings
     except Exception as e:
         print(f"❌ 同步加载配置失败: {e}")
@@ -94,24 +190,44 @@ async def update_setting(key: str, value: any, description: str = ""):
     """更新配置项"""
     try:
         val_json = json.dumps(value, ensure_ascii=False)
-        async with aiosqlite.connect(DB_PATH) as db:
+        db = await get_db()
+        async with _get_write_lock():
             await db.execute(
-                "INSERT OR REPLACE INTO settings (key, value, description) VALUES (?, ?, ?)",
+                SQL_UPSERT_SETTING,
                 (key, val_json, description)
             )
             await db.commit()
+        if _settings_cache is not None:
+            _settings_cache[key] = value
     except Exception as e:
         logger.error(f"❌ 更新配置失败 [{key}]: {e}")
 
+async def update_settings_bulk(items: dict, description: str = ""):
+    """批量更新配置项 (单个事务，只提交一次)"""
+    try:
+        rows = [(key, json.dumps(value, ensure_ascii=False), description) for key, value in items.items()]
+        db = await get_db()
+        async with _get_write_lock():
+            await db.executemany(
+                SQL_UPSERT_SETTING,
+                rows
+            )
+            await db.commit()
+        if _settings_cache is not None:
+            _settings_cache.update(items)
+    except Exception as e:
+        logger.error(f"❌ 批量更新配置失败: {e}")
+
 async def get_setting(key: str, default=None):
-    """获取单个配置"""
+    """获取单个配置 (优先走内存缓存)"""
+    global _settings_cache
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute("SELECT value FROM settings WHERE key = ?", (key,))
-            row = await cursor.fetchone()
-            if row:
-                return json.loads(row[0])
-            return default
+        if _settings_cache is None:
+            db = await get_db()
+            async with db.execute("SELECT key, value FROM settings") as cursor:
+                rows = await cursor.fetchall()
+            _settings_cache = _decode_settings(rows)
+        return _settings_cache.get(key, default)
     except Exception as e:
         logger.error(f"❌ 获取配置失败 [{key}]: {e}")
         return default
@@ -121,9 +237,10 @@ async def get_setting(key: str, default=None):
 async def add_history(filename: str, size: int, duration: str = ""):
     """添加历史记录"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        db = await get_db()
+        async with _get_write_lock():
             await db.execute(
-                "INSERT INTO history (filename, size, duration, completed_at) VALUES (?, ?, ?, ?)",
+                SQL_INSERT_HISTORY,
                 (filename, size, duration, datetime.now())
             )
             await db.commit()
@@ -131,17 +248,32 @@ async def add_history(filename: str, size: int, duration: str = ""):
     except Exception as e:
         logger.error(f"❌ 保存历史记录失败: {e}")
 
+async def add_history_many(rows: list):
+    """批量添加历史记录 [(filename, size, duration, completed_at), ...]，单个事务只提交一次"""
+    if not rows:
+        return
+    try:
+        db = await get_db()
+        async with _get_write_lock():
+            await db.executemany(
+                SQL_INSERT_HISTORY,
+                rows
+            )
+            await db.commit()
+        logger.info(f"💾 已保存 {len(rows)} 条历史记录")
+    except Exception as e:
+        logger.error(f"❌ 批量保存历史记录失败: {e}")
+
 async def get_recent_history(limit=50):
     """获取最近历史记录"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
-            cursor = await db.execute(
-                "SELECT * FROM history ORDER BY completed_at DESC LIMIT ?",
-                (limit,)
-            )
+        db = await get_db()
+        async with db.execute(
+            "SELECT id, filename, size, duration, completed_at FROM history ORDER BY completed_at DESC LIMIT ?",
+            (limit,)
+        ) as cursor:
             rows = await cursor.fetchall()
-            return [dict(row) for row in rows]
+        return [HistoryRow(*row) for row in rows]
     except Exception as e:
         logger.error(f"❌ 读取历史记录失败: {e}")
         return []
@@ -149,7 +281,8 @@ async def get_recent_history(limit=50):
 async def clear_history():
     """清空历史记录"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        db = await get_db()
+        async with _get_write_lock():
             await db.execute("DELETE FROM history")
             await db.commit()
             logger.info("🗑️ 历史记录已清空")
@@ -168,41 +301,74 @@ async def save_active_task(task_data: dict):
         file_name = task_data['file_name']
         file_size = task_data['file_size']
         status = task_data['status']
-        json_data = json.dumps(task_data, ensure_ascii=False)
+        json_data = _dumps(task_data)
         
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("""
-                INSERT OR REPLACE INTO active_tasks 
-                (message_id, chat_id, file_name, file_size, status, data, updated_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (message_id, chat_id, file_name, file_size, status, json_data, datetime.now()))
+        db = await get_db()
+        async with _get_write_lock():
+            await db.execute(
+                SQL_UPSERT_TASK,
+                (message_id, chat_id, file_name, file_size, status, json_data, datetime.now())
+            )
             await db.commit()
+        return True
     except Exception as e:
         logger.error(f"❌ 保存任务进度失败 [{task_data.get('file_name')}]: {e}")
+        return False
 
 async def load_active_task(message_id: int, chat_id: int):
     """加载活动任务进度"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
-            cursor = await db.execute(
-                "SELECT data FROM active_tasks WHERE message_id = ? AND chat_id = ?",
-                (message_id, chat_id)
-            )
+        db = await get_db()
+        async with db.execute(
+            SQL_SELECT_TASK,
+            (message_id, chat_id)
+        ) as cursor:
             row = await cursor.fetchone()
-            if row:
-                return json.loads(row['data'])
-            return None
+        if row:
+            return _loads(row['data'])
+        return None
     except Exception as e:
         logger.error(f"❌ 读取任务进度失败: {e}")
         return None
 
+async def find_active_task(message_id: int):
+    """按 message_id 查找活动任务 (调用方不知道 chat_id 时使用)"""
+    try:
+        db = await get_db()
+        async with db.execute(
+            "SELECT data FROM active_tasks WHERE message_id = ? LIMIT 1",
+            (message_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row:
+            return _loads(row['data'])
+        return None
+    except Exception as e:
+        logger.error(f"❌ 查找任务进度失败: {e}")
+        return None
+
+async def list_active_tasks(status: str = None):
+    """列出活动任务 (可按状态过滤)，按更新时间倒序"""
+    try:
+        db = await get_db()
+        if status is None:
+            sql, params = "SELECT data FROM active_tasks ORDER BY updated_at DESC", ()
+        else:
+            sql, params = "SELECT data FROM active_tasks WHERE status = ? ORDER BY updated_at DESC", (status,)
+        async with db.execute(sql, params) as cursor:
+            rows = await cursor.fetchall()
+        return [_loads(row['data']) for row in rows]
+    except Exception as e:
+        logger.error(f"❌ 读取任务列表失败: {e}")
+        return []
+
 async def delete_active_task(message_id: int, chat_id: int):
     """删除活动任务进度 (任务完成或取消后)"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        db = await get_db()
+        async with _get_write_lock():
             await db.execute(
-                "DELETE FROM active_tasks WHERE message_id = ? AND chat_id = ?",
+                SQL_DELETE_TASK,
                 (message_id, chat_id)
             )
             await db.commit()
@@ -3,19 +3,29 @@ Telethon 下载引擎 (完整版)
 实现并发下载、断点续传（跨重启）、任务管理
 """
 import asyncio
+import errno
 import os
+import sys
+import threading
 import time
-import math
 import json
-from collections import deque
+from collections import deque, Counter
+from contextlib import suppress
 from datetime import datetime
 from typing import Optional, Deque, List, Dict
-from dataclasses import dataclass, asdict, field
+from dataclasses import dataclass, field
 from telethon import TelegramClient, types
 from telethon.sessions import StringSession
 from config import Config
 import logging
 
+# 分片完整性校验: 安装了 xxhash 时下载中定期记录分片前缀的 xxh3 检查点，
+# 续传时校验并截断回最后一个通过校验的检查点 (未安装则只按文件大小续传)
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 # 配置日志
 logging.basicConfig(
     format='%(asctime)s | %(levelname)-7s | %(message)s',
@@ -28,19 +38,91 @@ logging.basicConfig(
 )
 logger = logging.getLogger("TelethonEngine")
 
+# 合并分片: 优先 copy_file_range，其次 Linux 文件到文件的 sendfile，其他平台回退到大缓冲区复制
+USE_SENDFILE = sys.platform.startswith('linux') and hasattr(os, 'sendfile')
+USE_COPY_FILE_RANGE = hasattr(os, 'copy_file_range')
+COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP}
+MERGE_BUFFER_SIZE = 16 * 1024 * 1024
+# 并发合并的分片数
+MERGE_CONCURRENCY = 4
+# 合并中的临时文件后缀: 所有分片写完后才重命名为最终文件
+MERGE_TMP_SUFFIX = '.tmp'
+# 回退复制路径的线程内缓冲区
+_merge_local = threading.local()
+
+# 字节 -> MB 换算 (日志、面板显示用)
+MB = 1024 * 1024
+
+# 分片写入队列长度 (单位: 块)，限制接收领先写入的内存占用
+WRITE_QUEUE_SIZE = 4
+# 分片文件写缓冲区大小
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+# 分片进度上报粒度: 每写入这么多字节才更新一次监控数据 (写完时总会更新)
+PROGRESS_UPDATE_BYTES = 1024 * 1024
+# 分片校验检查点间隔: 每写入这么多字节 fsync 一次并记录前缀哈希 (写完时总会记录)
+CHECKPOINT_BYTES = 4 * 1024 * 1024
+
+# 终端监控面板 (固定 5 行: 分隔线 + 3 行内容 + 分隔线)
+MONITOR_SEP = '═' * 60
+MONITOR_BAR_LEN = 30
+MONITOR_MAX_ACTIVE = 6
+MONITOR_LINES = 5
+MONITOR_CURSOR_UP = f"\033[{MONITOR_LINES}A"
+
+# 分片预分配: 使用 fallocate(FALLOC_FL_KEEP_SIZE) 只分配磁盘块不改变文件大小，
+# 断点续传仍然以分片文件大小作为已下载偏移 (posix_fallocate 会改变大小，不能用)
+FALLOC_FL_KEEP_SIZE = 0x01
+_libc = None
+
+def preallocate_keep_size(fd, length):
+    """为文件预留磁盘空间 (仅 Linux，失败时静默跳过)"""
+    global _libc
+    if not sys.platform.startswith('linux') or length <= 0:
+        return
+    try:
+        if _libc is None:
+            import ctypes
+            import ctypes.util
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+        _libc.fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, length)
+    except Exception:
+        pass
+
+def _stat_or_none(path):
+    """os.stat，文件不存在时返回 None"""
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
 # ==================== 数据结构 ====================
 
-@dataclass
-class FilePart:
-    """文件分片信息"""
-    index: int                # 分片序号
-    start_offset: int         # 起始字节 (包含)
-    end_offset: int           # 结束字节 (包含)
-    status: str = "pending"   # pending/downloading/completed
-    
-    @property
-    def size(self) -> int:
-        return self.end_offset - self.start_offset + 1
+# 分片信息直接使用 dict (与持久化格式一致，无需来回转换):
+#   index        分片序号
+#   start_offset 起始字节 (包含)
+#   end_offset   结束字节 (包含)
+#   status       pending/downloading/completed/error
+#   ckpt         [已落盘字节数, 该前缀的 xxh3] 校验检查点 (可选，仅未完成的分片保留)
+# 持久化时只保存 part_size 和每个分片一个字符的状态串，偏移量加载时重新计算
+# (大文件有上万个分片，逐个保存 dict 会让每次进度保存都写出数 MB 的 JSON)
+PART_STATUS_CODES = {'pending': 'p', 'downloading': 'd', 'completed': 'c', 'error': 'e'}
+PART_STATUS_NAMES = {code: name for name, code in PART_STATUS_CODES.items()}
+
+def build_parts(file_size, part_size, status_codes=None) -> List[Dict]:
+    """按分片大小切分文件 (status_codes 为持久化的状态串，缺省全部为 pending)"""
+    # 整数向上取整，避免浮点除法 (大文件时浮点精度也不可靠)
+    num_parts = (file_size + part_size - 1) // part_size if file_size > 0 else 1
+    last = file_size - 1
+    return [
+        {
+            "index": i,
+            "start_offset": i * part_size,
+            "end_offset": min((i + 1) * part_size - 1, last) if file_size > 0 else 0,
+            "status": PART_STATUS_NAMES.get(status_codes[i], 'pending') if status_codes else "pending",
+        }
+        for i in range(num_parts)
+    ]
 
 @dataclass
 class DownloadTask:
@@ -65,6 +147,8 @@ class DownloadTask:
 
     def to_dict(self):
         # 手动构建字典，避免 asdict 深度递归导致序列化 message 出错
+        parts = self.parts
+        part_size = parts[0]['end_offset'] - parts[0]['start_offset'] + 1 if parts else Config.PART_SIZE
         return {
             "message_id": self.message_id,
             "chat_id": self.chat_id,
@@ -72,13 +156,26 @@ class DownloadTask:
             "file_size": self.file_size,
             "downloaded_bytes": self.downloaded_bytes,
             "status": self.status,
-            "parts": self.parts,
+            "part_size": part_size,
+            "part_status": "".join([PART_STATUS_CODES.get(p['status'], 'p') for p in parts]),
+            "part_checkpoints": [p.get('ckpt') for p in parts] if any('ckpt' in p for p in parts) else None,
             "created_at": self.created_at,
             "updated_at": self.updated_at
         }
     
     @classmethod
     def from_dict(cls, data):
+        data = dict(data)
+        # 旧记录直接保存了完整的 parts 列表；part_hashes 为旧版整分片哈希，已不再使用
+        data.pop('part_hashes', None)
+        checkpoints = data.pop('part_checkpoints', None)
+        if 'parts' not in data:
+            part_size = data.pop('part_size', Config.PART_SIZE)
+            data['parts'] = build_parts(data['file_size'], part_size, data.pop('part_status', None))
+        if checkpoints:
+            for p, ckpt in zip(data['parts'], checkpoints):
+                if ckpt:
+                    p['ckpt'] = ckpt
         return cls(**data)
 
 
@@ -89,21 +186,40 @@ import database
 # ==================== 下载管理器 ====================
 
 class TelethonDownloader:
+    # 进度保存合并间隔 (秒): 期间多次保存只落盘最后一次
+    SAVE_DELAY = 1.0
+    # 已取消任务列表的缓存时间 (秒): Dashboard 多个客户端同时轮询时只查一次库
+    CANCELLED_CACHE_TTL = 0.5
+
     def __init__(self, client: TelegramClient):
         self.client = client
         self.tasks: Deque[DownloadTask] = deque()
+        self._queued_keys = set()  # 队列中任务的 (chat_id, message_id)，O(1) 去重
         self.current_task: Optional[DownloadTask] = None
         self.is_running = False
         
         # Worker Pool
         self.workers: List[TelegramClient] = []
-        self.worker_lock = asyncio.Lock()
+        self._init_lock = asyncio.Lock()  # 仅用于首次初始化 / 清理，下载路径不加锁
         self.worker_queue = asyncio.Queue()
         self._session_str = None  # 延迟保存 Session 字符串
         
         # 取消信号
         self.cancel_event = asyncio.Event()
         
+        # 待保存的任务进度 (由后台任务合并写入)
+        self._dirty_tasks: Dict[tuple, DownloadTask] = {}
+        self._dirty_event = asyncio.Event()
+        self._flusher_task = None
+        self._flush_lock = asyncio.Lock()  # 写出进度与删除记录互斥，避免已删除的记录被写回
+        
+        # 待写入的历史记录 (队列清空时批量提交)
+        self._pending_history = []
+        
+        # 已取消任务列表缓存: (生成时间, 列表)，任务记录变化时清空
+        self._cancelled_cache = None
+        self._cancelled_lock = asyncio.Lock()
+        
         # 确保目录存在
         Config.ensure_directories()
         
@@ -111,21 +227,60 @@ class TelethonDownloader:
         self.current_speed = 0.0
         self.current_percent = 0.0
         self.current_eta = "N/A"
+        self._reset_part_state()
+
+    def _reset_part_state(self):
+        """重置当前任务的分片状态与汇总计数"""
+        self.active_parts = {}  # Map: part_index -> downloaded
+        self.part_status = {}   # Map: part_index -> status
+        self._status_counts = Counter()  # status -> 分片数
+        self._active_indices = set()     # waiting/downloading 的分片
+        self._total_downloaded = 0       # active_parts 之和
+        self._state_rev = 0              # 分片状态每次变化 +1 (监控面板据此跳过重建，进度变化不计入)
+
+    def _set_part_status(self, index, status):
+        """更新分片状态，同时维护各状态计数"""
+        old = self.part_status.get(index)
+        if old is not None:
+            self._status_counts[old] -= 1
+        self._status_counts[status] += 1
+        self.part_status[index] = status
+        self._state_rev += 1
+        if status in ('waiting', 'downloading'):
+            self._active_indices.add(index)
+        else:
+            self._active_indices.discard(index)
+
+    def _set_part_progress(self, index, downloaded):
+        """更新分片已下载量，同时维护总下载量"""
+        self._total_downloaded += downloaded - self.active_parts.get(index, 0)
+        self.active_parts[index] = downloaded
 
     async def _ensure_workers_ready(self):
-        """确保 Worker 客户端池就绪（延迟初始化）"""
-        async with self.worker_lock:
-            # 如果队列为空但有 workers，检查连接状态
-            if self.workers:
-                # 检查第一个 worker 的连接状态
-                sample_worker = self.workers[0]
-                if not sample_worker.is_connected():
-                    logger.info("🔄 检测到 Worker 连接断开，正在重新连接...")
-                    await self._reconnect_all_workers()
-                return
-            
-            # 首次初始化
-            await self._initialize_workers_internal()
+        """确保 Worker 客户端池就绪（延迟初始化，连接状态在取用时逐个检查）"""
+        if self.workers:
+            return
+        async with self._init_lock:
+            # 首次初始化 (等待锁期间可能已被其他调用完成)
+            if not self.workers:
+                await self._initialize_workers_internal()
+
+    async def _acquire_worker(self) -> TelegramClient:
+        """从池中取出一个 Worker，断线时只重连这一个"""
+        worker = await self.worker_queue.get()
+        if not worker.is_connected():
+            try:
+                logger.info("🔄 检测到 Worker 连接断开，正在重新连接...")
+                await worker.connect()
+            except BaseException:
+                self._release_worker(worker)
+                raise
+        return worker
+
+    def _release_worker(self, worker: TelegramClient):
+        """归还 Worker (已被清理出池的不再放回)"""
+        if worker in self.workers:
+            self.worker_queue.put_nowait(worker)
     
     async def _initialize_workers_internal(self):
         """内部初始化方法"""
@@ -135,58 +290,44 @@ class TelethonDownloader:
         # 导出主客户端 Session
         self._session_str = StringSession.save(self.client.session)
         
-        for i in range(Config.WORKER_COUNT):
-            try:
-                worker = TelegramClient(
-                    StringSession(self._session_str),
-                    Config.API_ID,
-                    Config.API_HASH,
-                    proxy=self.client._proxy,
-                    device_model="Desktop",
-                    system_version="Windows 10",
-                    app_version="4.16.8 x64",
-                    lang_code="en"
-                )
-                await worker.connect()
-                self.workers.append(worker)
-                self.worker_queue.put_nowait(worker)
-                logger.info(f"  ✅ Worker {i+1} 就绪")
-            except Exception as e:
-                logger.error(f"  ❌ Worker {i+1} 初始化失败: {e}")
+        async def make_worker():
+            worker = TelegramClient(
+                StringSession(self._session_str),
+                Config.API_ID,
+                Config.API_HASH,
+                proxy=self.client._proxy,
+                device_model="Desktop",
+                system_version="Windows 10",
+                app_version="4.16.8 x64",
+                lang_code="en"
+            )
+            await worker.connect()
+            return worker
         
-        logger.info(f"✨ Worker 初始化完成，可用: {len(self.workers)}")
-
-    async def _reconnect_all_workers(self):
-        """重新连接所有 Worker"""
-        # 清空队列
-        while not self.worker_queue.empty():
-            try:
-                self.worker_queue.get_nowait()
-            except:
-                break
+        # 并发建立连接，启动耗时约为一次握手而不是 N 次
+        results = await asyncio.gather(
+            *(make_worker() for _ in range(Config.WORKER_COUNT)),
+            return_exceptions=True
+        )
+        for i, result in enumerate(results):
+            if isinstance(result, BaseException):
+                logger.error(f"  ❌ Worker {i+1} 初始化失败: {result}")
+                continue
+            self.workers.append(result)
+            self.worker_queue.put_nowait(result)
+            logger.info(f"  ✅ Worker {i+1} 就绪")
         
-        # 重新连接每个 worker
-        for i, worker in enumerate(self.workers):
-            try:
-                if not worker.is_connected():
-                    await worker.connect()
-                self.worker_queue.put_nowait(worker)
-                logger.info(f"  ✅ Worker {i+1} 重连成功")
-            except Exception as e:
-                logger.error(f"  ❌ Worker {i+1} 重连失败: {e}")
-
-                logger.error(f"  ❌ Worker {i+1} 重连失败: {e}")
+        logger.info(f"✨ Worker 初始化完成，可用: {len(self.workers)}")
 
     async def _cleanup_workers(self):
-        """强制清理所有 Workers (用于取消任务时的硬重置)"""
+        """强制清理所有 Workers (停止下载器时断开连接)"""
         logger.info("🧹 正在强制清理 Worker 连接...")
-        async with self.worker_lock:
-            for w in self.workers:
-                try:
-                    if w.is_connected():
-                        await w.disconnect()
-                except:
-                    pass
+        async with self._init_lock:
+            # 并发断开，异常忽略
+            await asyncio.gather(
+                *(w.disconnect() for w in self.workers if w.is_connected()),
+                return_exceptions=True
+            )
             self.workers = []
             
             # 清空队列
@@ -204,62 +345,69 @@ class TelethonDownloader:
         
     async def add_task(self, message):
         """添加下载任务 (支持断点续传)"""
-        task = self._init_or_load_task(message)
+        task = await self._init_or_load_task(message)
         
-        # 如果任务已经完成（且文件完整），则跳过
-        file_path = os.path.join(Config.DOWNLOAD_DIR, task.file_name)
-        if task.status == 'completed' and os.path.exists(file_path) and os.path.getsize(file_path) == task.file_size:
-            logger.info(f"✅ 文件已存在，跳过: {task.file_name}")
-            return
+        # 如果任务已经完成（且文件完整），则跳过 (一次 stat 同时判断存在与大小，在线程中进行)
+        if task.status == 'completed':
+            file_path = os.path.join(Config.DOWNLOAD_DIR, task.file_name)
+            st = await asyncio.to_thread(_stat_or_none, file_path)
+            if st is not None and st.st_size == task.file_size:
+                logger.info(f"✅ 文件已存在，跳过: {task.file_name}")
+                return
 
         # 加入队列
         # 避免队列中重复添加
-        for t in self.tasks:
-            if t.message_id == task.message_id and t.chat_id == task.chat_id:
-                logger.info(f"⚠️ 任务已在队列中: {task.file_name}")
-                return
+        if not self._enqueue(task):
+            logger.info(f"⚠️ 任务已在队列中: {task.file_name}")
+            return
         
-        self.tasks.append(task)
-        logger.info(f"➕ 已添加任务: {task.file_name} ({task.file_size/1024/1024:.2f} MB) [队列: {len(self.tasks)}]")
+        logger.info(f"➕ 已添加任务: {task.file_name} ({task.file_size / MB:.2f} MB) [队列: {len(self.tasks)}]")
         
         # 启动处理
         if not self.is_running:
             asyncio.create_task(self.process_queue())
 
-    def _init_or_load_task(self, message) -> DownloadTask:
+    def _enqueue(self, task: DownloadTask) -> bool:
+        """加入等待队列，已在队列中时返回 False"""
+        key = (task.chat_id, task.message_id)
+        if key in self._queued_keys:
+            return False
+        self._queued_keys.add(key)
+        self.tasks.append(task)
+        return True
+
+    def _is_running_task(self, task: DownloadTask) -> bool:
+        """是否为当前正在处理的任务"""
+        current = self.current_task
+        return current is not None and (current.chat_id, current.message_id) == (task.chat_id, task.message_id)
+
+    async def _init_or_load_task(self, message) -> DownloadTask:
         """加载或初始化任务"""
-        progress_file = Config.get_progress_file_path(message.id, message.chat_id)
-        
         # 1. 尝试加载现有任务
-        if os.path.exists(progress_file):
+        data = await database.load_active_task(message.id, message.chat_id)
+        if data:
             try:
-                with open(progress_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    task = DownloadTask.from_dict(data)
-                    task.message = message # 重新关联 message 对象
-                    logger.info(f"🔄 恢复任务: {task.file_name} (进度: {task.progress_percent:.1f}%)")
-                    return task
+                task = DownloadTask.from_dict(data)
+                task.message = message # 重新关联 message 对象
+                logger.info(f"🔄 恢复任务: {task.file_name} (进度: {task.progress_percent:.1f}%)")
+                return task
             except Exception as e:
-                logger.warning(f"⚠️ 进度文件损坏，重新创建: {e}")
+                logger.warning(f"⚠️ 任务进度记录损坏，重新创建: {e}")
         
         # 2. 创建新任务
-        # 获取文件名
-        file_name = "unknown"
-        if message.file:
-            file_name = message.file.name or f"file_{message.id}{message.file.ext}"
-        
-        file_size = message.file.size if message.file else 0
+        # 获取文件名 (message.file 是属性访问，只取一次)
+        media_file = message.file
+        if media_file:
+            file_name = media_file.name or f"file_{message.id}{media_file.ext}"
+            file_size = media_file.size
+        else:
+            file_name = "unknown"
+            file_size = 0
         
         # 计算分片
-        part_size = Config.PART_SIZE
-        num_parts = math.ceil(file_size / part_size) if file_size > 0 else 1
-        
-        parts = []
-        for i in range(num_parts):
-            start = i * part_size
-            end = min((i + 1) * part_size - 1, file_size - 1) if file_size > 0 else 0
-            parts.append(asdict(FilePart(index=i, start_offset=start, end_offset=end)))
+        parts = build_parts(file_size, Config.PART_SIZE)
             
+        now_iso = datetime.now().isoformat()
         task = DownloadTask(
             message_id=message.id,
             chat_id=message.chat_id,
@@ -267,40 +415,68 @@ class TelethonDownloader:
             file_size=file_size,
             status="pending",
             parts=parts,
-            created_at=datetime.now().isoformat(),
-            updated_at=datetime.now().isoformat(),
+            created_at=now_iso,
+            updated_at=now_iso,
             message=message
         )
         self._save_task(task)
         return task
 
     def _save_task(self, task: DownloadTask):
-        """保存任务进度到 JSON"""
-        task.updated_at = datetime.now().isoformat()
-        progress_file = Config.get_progress_file_path(task.message_id, task.chat_id)
-        
-        # 计算已下载量
-        total = 0
-        # 简单估算：完成的分片 + 正在下载分片的已下载量
-        # 这里为了简化，只统计 'completed' 的分片。更精确的需要读取 .part 文件大小
-        
-        try:
-            with open(progress_file, 'w', encoding='utf-8') as f:
-                json.dump(task.to_dict(), f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.error(f"❌ 保存进度失败: {e}")
+        """标记任务进度待保存 (后台合并写入，任务结束时立即落盘)"""
+        # 已下载量直接取内存中的实时分片进度，无需 stat 分片文件
+        if task is self.current_task and self.active_parts:
+            task.downloaded_bytes = self._total_downloaded
+        self._dirty_tasks[(task.chat_id, task.message_id)] = task
+        if self._flusher_task is None or self._flusher_task.done():
+            self._flusher_task = asyncio.create_task(self._flush_loop())
+        self._dirty_event.set()
+
+    async def _flush_loop(self):
+        """后台进度写入: 等待脏标记，稍作延迟后一次性写出"""
+        while True:
+            await self._dirty_event.wait()
+            await asyncio.sleep(self.SAVE_DELAY)
+            self._dirty_event.clear()
+            await self._flush_dirty()
+
+    async def _flush_history(self):
+        """批量写入已完成任务的历史记录"""
+        rows, self._pending_history = self._pending_history, []
+        await database.add_history_many(rows)
+
+    async def _flush_dirty(self):
+        """立即写出所有待保存的任务进度 (active_tasks 表)"""
+        async with self._flush_lock:
+            dirty, self._dirty_tasks = self._dirty_tasks, {}
+            if not dirty:
+                return
+            # 更新时间只在真正写入时生成一次
+            now_iso = datetime.now().isoformat()
+            try:
+                for task in dirty.values():
+                    task.updated_at = now_iso
+                    await database.save_active_task(task.to_dict())
+            except BaseException:
+                # 写出被取消时放回待保存集合 (重复写入无害)，由下一次写出补上
+                for key, task in dirty.items():
+                    self._dirty_tasks.setdefault(key, task)
+                raise
+        self._cancelled_cache = None
+
+    async def _forget_task(self, chat_id, message_id):
+        """删除任务进度记录，同时丢弃尚未写出的进度 (与写出互斥，避免被后台写回)"""
+        async with self._flush_lock:
+            self._dirty_tasks.pop((chat_id, message_id), None)
+            await database.delete_active_task(message_id, chat_id)
+        self._cancelled_cache = None
 
     async def stop(self):
         """完全停止下载器"""
         self.is_running = False
         self.cancel_event.set()
         
-        # 保存当前任务状态
-        if self.current_task:
-            logger.info("🛑 正在保存当前任务状态...")
-            self._save_task(self.current_task)
-        
-        # 取消主队列任务
+        # 先取消主队列任务并等待退出: 它的 finally 还会保存任务状态，必须在最后一次写出之前完成
         if hasattr(self, 'queue_task') and self.queue_task and not self.queue_task.done():
             logger.info("🛑 正在取消主任务队列...")
             self.queue_task.cancel()
@@ -309,6 +485,19 @@ class TelethonDownloader:
             except asyncio.CancelledError:
                 pass
             self.queue_task = None
+        
+        # 保存当前任务状态
+        if self.current_task:
+            logger.info("🛑 正在保存当前任务状态...")
+            self._save_task(self.current_task)
+        await self._flush_dirty()
+        await self._flush_history()
+        
+        # 停止后台写入，之后不再访问数据库 (调用方随后可以安全关闭连接)
+        if self._flusher_task and not self._flusher_task.done():
+            self._flusher_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._flusher_task
             
         # 强制清理 worker 以中断网络连接
         await self._cleanup_workers()
@@ -322,10 +511,11 @@ class TelethonDownloader:
         while self.tasks:
             self.current_task = self.tasks.popleft()
             task = self.current_task
+            self._queued_keys.discard((task.chat_id, task.message_id))
             
             logger.info(f"\n{'='*50}")
             logger.info(f"🚀 开始任务: {task.file_name}")
-            logger.info(f"📊 文件大小: {task.file_size/1024/1024:.2f} MB")
+            logger.info(f"📊 文件大小: {task.file_size / MB:.2f} MB")
             logger.info(f"{'='*50}")
             
             try:
@@ -347,28 +537,40 @@ class TelethonDownloader:
                 # 1. 扫描分片状态
                 # 检查哪些分片还没完成
                 pending_parts = []
-                self.active_parts = {} # Map: part_index -> downloaded
-                self.part_status = {}  # Map: part_index -> status
+                self._reset_part_state()
                 
-                for p_data in task.parts:
-                    p = FilePart(**p_data)
-                    part_path = f"{temp_base_path}.part{p.index}"
+                # 一次目录遍历取得所有已有分片的大小，避免每个分片一次 stat (在线程中进行)
+                existing_parts, final_exists, merging = await asyncio.to_thread(
+                    lambda: (
+                        self._scan_part_sizes(task.file_name),
+                        os.path.exists(file_path),
+                        os.path.exists(file_path + MERGE_TMP_SUFFIX),
+                    )
+                )
+                first_index = task.parts[0]['index'] if task.parts else None
+                
+                for p in task.parts:
+                    index = p['index']
                     
                     # 检查分片文件真实状态
-                    if p.status == 'completed':
-                        # 如果标记完成但文件不存在
-                        # 注意：如果最终文件存在，可能分片已经被合并删除了
-                        if not os.path.exists(part_path) and not os.path.exists(file_path):
-                            p.status = 'pending'
+                    if p['status'] == 'completed':
+                        # 如果标记完成但分片文件不存在或不完整
+                        # 注意：如果最终文件存在，可能分片已经被合并删除了；
+                        # 上次合并中断时，首个分片已被移入合并临时文件
+                        size = existing_parts.get(index)
+                        expected = p['end_offset'] - p['start_offset'] + 1
+                        in_merge_file = merging and index == first_index and size is None
+                        if not final_exists and not in_merge_file and (size is None or size < expected):
+                            p['status'] = 'pending'
                             
-                    if p.status != 'completed':
+                    if p['status'] != 'completed':
                         pending_parts.append(p)
-                        self.active_parts[p.index] = 0
-                        self.part_status[p.index] = 'pending'
+                        self._set_part_progress(index, 0)
+                        self._set_part_status(index, 'pending')
                     else:
                         # 已完成的分片
-                        self.active_parts[p.index] = p.size
-                        self.part_status[p.index] = 'completed'
+                        self._set_part_progress(index, p['end_offset'] - p['start_offset'] + 1)
+                        self._set_part_status(index, 'completed')
                 
                 if not pending_parts:
                     logger.info("🎉 所有分片已完成，准备合并...")
@@ -381,7 +583,7 @@ class TelethonDownloader:
                     
                     # 初始化进度追踪
                     self._total_parts = len(task.parts)
-                    self._start_time = time.time()
+                    self._start_time = time.monotonic()
                     
                     # 启动监控面板
                     monitor_stop = asyncio.Event()
@@ -389,29 +591,40 @@ class TelethonDownloader:
                         self.monitor_progress(task, len(task.parts), monitor_stop)
                     )
                     
+                    def abort_on_error(t):
+                        # 任一分片失败后取消其余分片，不再做无用的下载
+                        if not t.cancelled() and t.exception() is not None:
+                            for other in download_tasks:
+                                other.cancel()
+                    
                     for part in pending_parts:
-                        part_path = f"{temp_base_path}.part{part.index}"
-                        download_tasks.append(
-                            asyncio.create_task(self.download_part_worker(semaphore, task, part, part_path))
-                        )
+                        part_path = f"{temp_base_path}.part{part['index']}"
+                        t = asyncio.create_task(self.download_part_worker(semaphore, task, part, part_path))
+                        t.add_done_callback(abort_on_error)
+                        download_tasks.append(t)
                     
                     # 监控取消事件
                     cancel_waiter = asyncio.create_task(self.cancel_event.wait())
                     
                     # 核心逻辑：等待 "所有下载完成" 或者 "取消信号触发"
-                    # 我们把所有下载任务打包成一个 awaitable
-                    main_download_group = asyncio.gather(*download_tasks)
+                    # 我们把所有下载任务打包成一个 awaitable (异常作为结果返回，由完成计数判断成败)
+                    main_download_group = asyncio.gather(*download_tasks, return_exceptions=True)
                     
                     try:
                         done, pending = await asyncio.wait(
                             [main_download_group, cancel_waiter], 
                             return_when=asyncio.FIRST_COMPLETED
                         )
-                    except Exception as e:
-                        # 异常处理：取消所有任务
+                    except BaseException:
+                        # 异常或主任务被取消 (stop)：取消所有任务，并等待分片退出，
+                        # 保证随后保存的进度完整，且退出后不再有分片在后台写文件
                         main_download_group.cancel()
                         cancel_waiter.cancel()
-                        raise e
+                        monitor_stop.set()
+                        monitor_task.cancel()
+                        with suppress(asyncio.CancelledError):
+                            await main_download_group
+                        raise
 
                     # Case 1: 取消触发
                     # Case 1: 取消触发
@@ -419,9 +632,8 @@ class TelethonDownloader:
                         monitor_stop.set() # 立即停止监控
                         logger.warning(f"⛔ 任务被取消: {task.file_name}")
                         
-                        # 架构优化：立即物理断开网络连接，强制中断 Telethon IO
-                        await self._cleanup_workers()
-                        
+                        # 取消协程即可中断 Telethon 等待中的请求，Worker 连接保持不断，
+                        # 下一个任务无需重新握手 (完全停止时由 stop() 清理连接)
                         main_download_group.cancel() # 取消正在进行的下载
                         monitor_task.cancel() # 取消监控任务
                         try:
@@ -435,31 +647,17 @@ class TelethonDownloader:
                         self._save_task(task)
                         continue
 
-                    # Case 2: 下载任务组完成 (可能是成功，也可能是异常)
+                    # Case 2: 下载任务组完成 (可能是成功，也可能有分片失败)
                     if main_download_group in done:
                         cancel_waiter.cancel() # 不需要再等取消了
-                        
-                        # 检查 gather 的结果是否有异常
-                        # gather 默认会把异常抛出来，或者包含在结果里
-                        try:
-                            await main_download_group
-                        except Exception as e:
-                            # 真正的下载错误
-                            raise e 
 
 
                     # 停止监控
                     monitor_stop.set()
                     await asyncio.sleep(0.1)  # 让监控有机会最后刷新一次
                 
-                # 再次检查是否全部完成
-                all_done = True
-                for p_data in task.parts:
-                    if p_data['status'] != 'completed':
-                        all_done = False
-                        break
-                
-                if all_done:
+                # 检查是否全部完成
+                if self._status_counts['completed'] == len(task.parts):
                     # 合并这一步
                     await self.merge_parts(task, file_path)
                 else:
@@ -474,61 +672,104 @@ class TelethonDownloader:
                 import traceback
                 traceback.print_exc()
             finally:
-                self._save_task(task)
+                # 已完成的任务记录已在合并后删除，不能再写回
+                if task.status != "completed":
+                    self._save_task(task)
+                await self._flush_dirty()
                 self.current_task = None
                 
+        await self._flush_history()
         self.is_running = False
         logger.info("💤 队列已空")
 
-    async def download_part_worker(self, semaphore, task, part: FilePart, part_path):
-        """Worker - 下载单个分片"""
+    @staticmethod
+    def _scan_part_sizes(file_name) -> Dict[int, int]:
+        """扫描临时目录，返回该文件已存在分片的 {index: size}"""
+        prefix = f"{file_name}.part"
+        sizes = {}
+        try:
+            with os.scandir(Config.TEMP_DIR) as it:
+                for entry in it:
+                    name = entry.name
+                    if name.startswith(prefix) and name[len(prefix):].isdigit():
+                        try:
+                            sizes[int(name[len(prefix):])] = entry.stat().st_size
+                        except OSError:
+                            pass
+        except FileNotFoundError:
+            pass
+        return sizes
+
+    async def download_part_worker(self, semaphore, task, part: dict, part_path):
+        """Worker - 下载单个分片 (part 为 task.parts 中的分片 dict)"""
+        index = part['index']
         async with semaphore:
-            self.part_status[part.index] = "waiting"
-            worker_client = await self.worker_queue.get()
+            self._set_part_status(index, "waiting")
+            worker_client = await self._acquire_worker()
             
             try:
-                self.part_status[part.index] = "downloading"
-                task.parts[part.index]['status'] = 'downloading'
+                self._set_part_status(index, "downloading")
+                part['status'] = 'downloading'
                 # 移除 INFO 日志以避免干扰监控面板
-                # logger.info(f"▶️  Worker 开始下载分片 P{part.index} ({part.size/1024/1024:.1f} MB)")
+                # logger.info(f"▶️  Worker 开始下载分片 P{index}")
                 
                 try:
-                    await self.download_part_telethon(worker_client, task.message, part_path, part.index, part.start_offset, part.end_offset)
+                    await self.download_part_telethon(
+                        worker_client, task.message, part_path, index, part['start_offset'], part['end_offset'], part
+                    )
                     
-                    task.parts[part.index]['status'] = 'completed'
-                    self.part_status[part.index] = "completed"
+                    # 完成的分片已 fsync，不再需要检查点；立即标记保存，崩溃后无需重新校验
+                    part.pop('ckpt', None)
+                    part['status'] = 'completed'
+                    self._set_part_status(index, "completed")
+                    self._save_task(task)
                     # 移除 INFO 日志以避免干扰监控面板
-                    # logger.info(f"✅ 分片 P{part.index} 完成")
+                    # logger.info(f"✅ 分片 P{index} 完成")
                     
                 except asyncio.CancelledError:
-                    task.parts[part.index]['status'] = 'pending' # 重置为 pending 以便下次恢复
-                    self.part_status[part.index] = "cancelled"
+                    part['status'] = 'pending' # 重置为 pending 以便下次恢复
+                    self._set_part_status(index, "cancelled")
                     raise
                 except Exception as e:
-                    self.part_status[part.index] = "error"
-                    task.parts[part.index]['status'] = 'error'
+                    self._set_part_status(index, "error")
+                    part['status'] = 'error'
                     
                     # 只有在非主动取消的情况下才打印错误日志
                     # "Cannot send requests while disconnected" 是物理中断连接后的正常现象
                     if not self.cancel_event.is_set():
-                        logger.error(f"❌ P{part.index} 失败: {e}")
+                        logger.error(f"❌ P{index} 失败: {e}")
                     raise e
             finally:
-                self.worker_queue.put_nowait(worker_client)
+                self._release_worker(worker_client)
 
-    async def download_part_telethon(self, client: TelegramClient, message, part_path, part_index, start_byte, end_byte):
-        """底层的 Telethon 分片下载"""
+    async def download_part_telethon(self, client: TelegramClient, message, part_path, part_index, start_byte, end_byte, part=None):
+        """底层的 Telethon 分片下载 (part 为分片 dict，用于读写校验检查点)"""
         current_offset = 0
         expected_size = end_byte - start_byte + 1
+        hasher = xxhash.xxh3_64() if xxhash is not None else None
         
-        # 断点续传检查
-        if os.path.exists(part_path):
-            current = os.path.getsize(part_path)
+        # 断点续传检查 (一次 stat 同时判断存在与大小)
+        st = _stat_or_none(part_path)
+        if st is not None and hasher is not None:
+            # 只信任通过校验的检查点: 校验前缀并截断掉之后的部分 (崩溃时可能写坏的尾部)
+            current_offset = await asyncio.to_thread(
+                self._resume_from_checkpoint, part_path, st.st_size, (part or {}).get('ckpt'), hasher
+            )
+            if current_offset < 0:
+                logger.warning(f"⚠️ P{part_index} 校验失败，重新下载")
+                current_offset = 0
+                hasher = xxhash.xxh3_64()
+            if current_offset >= expected_size:
+                self._set_part_progress(part_index, expected_size)
+                return
+            self._set_part_progress(part_index, current_offset)
+        elif st is not None:
+            current = st.st_size
             if current >= expected_size:
-                self.active_parts[part_index] = expected_size
+                self._set_part_progress(part_index, expected_size)
                 return
             current_offset = current
-            self.active_parts[part_index] = current_offset
+            self._set_part_progress(part_index, current_offset)
         
         request_offset = start_byte + current_offset
         bytes_to_download = expected_size - current_offset
@@ -537,65 +778,292 @@ class TelethonDownloader:
         
         mode = 'ab' if current_offset > 0 else 'wb'
         
-        with open(part_path, mode) as f:
-            async for chunk in client.iter_download(
-                message,
-                offset=request_offset,
-                limit=bytes_to_download,
-                chunk_size=512 * 1024, # 512KB
-                request_size=512 * 1024,
-            ):
-                if self.cancel_event.is_set():
-                    raise asyncio.CancelledError("Task Cancelled")
+        # 大缓冲区把多个网络块合并成一次写入；打开与关闭 (关闭时 flush 整个缓冲区) 都在线程中进行
+        f = await asyncio.to_thread(self._open_part_file, part_path, mode, expected_size)
+        try:
+            # 网络接收与磁盘写入解耦: 接收循环只负责入队，写入在线程中进行
+            queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+            write_errors = []
+            writer = asyncio.create_task(
+                self._part_writer(f, hasher, queue, part, part_index, current_offset, expected_size, write_errors)
+            )
+            # iter_download 的 limit 是块数而不是字节数
+            request_size = Config.REQUEST_SIZE
+            try:
+                async for chunk in client.iter_download(
+                    message,
+                    offset=request_offset,
+                    limit=(bytes_to_download + request_size - 1) // request_size,
+                    chunk_size=request_size,
+                    request_size=request_size,
+                ):
+                    if self.cancel_event.is_set():
+                        raise asyncio.CancelledError("Task Cancelled")
+                    if write_errors:
+                        break
+                        
+                    # 计算剩余需要写入的字节数，防止溢出
+                    remaining = expected_size - current_offset
+                    if remaining <= 0:
+                        break
                     
-                # 计算剩余需要写入的字节数，防止溢出
-                remaining = expected_size - current_offset
-                if remaining <= 0:
-                    break
+                    # 如果 chunk 超出剩余空间，截断 (memoryview 切片不复制数据)
+                    if len(chunk) > remaining:
+                        chunk = memoryview(chunk)[:remaining]
+                    
+                    current_offset += len(chunk)
+                    await queue.put(chunk)
                 
-                # 如果 chunk 超出剩余空间，截断
-                if len(chunk) > remaining:
-                    chunk = chunk[:remaining]
+                # 结束标记，等待所有数据写完
+                await queue.put(None)
+                await writer
+            finally:
+                if not writer.done():
+                    writer.cancel()
+                    # 等待写入任务退出 (上报最终进度) 后再关闭文件
+                    with suppress(asyncio.CancelledError):
+                        await writer
+            
+            if write_errors:
+                raise write_errors[0]
+        finally:
+            await asyncio.to_thread(f.close)
+
+    @staticmethod
+    def _open_part_file(path, mode, expected_size):
+        """打开分片文件，设置顺序写入提示并预分配 (在线程中执行)"""
+        f = open(path, mode, buffering=WRITE_BUFFER_SIZE)
+        # 顺序写入提示，便于内核做预读与回写合并 (仅 Linux 等支持的平台)
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
+        # 预先分配整个分片的磁盘块，减少追加写入时的元数据更新与碎片
+        preallocate_keep_size(f.fileno(), expected_size)
+        return f
+
+    @staticmethod
+    def _delete_part_files(file_name):
+        """删除临时目录中该文件的所有分片，以及中断合并留下的合并临时文件"""
+        # 合并临时文件已预分配到完整大小，内容却可能残缺，不能留在下载目录
+        with suppress(FileNotFoundError):
+            os.remove(os.path.join(Config.DOWNLOAD_DIR, file_name + MERGE_TMP_SUFFIX))
+        prefix = f"{file_name}.part"
+        try:
+            it = os.scandir(Config.TEMP_DIR)
+        except FileNotFoundError:
+            return
+        with it:
+            for entry in it:
+                name = entry.name
+                if name.startswith(prefix) and name[len(prefix):].isdigit():
+                    try:
+                        os.remove(entry.path)
+                    except OSError as e:
+                        logger.error(f"删除分片失败 {entry.path}: {e}")
+
+    @staticmethod
+    def _write_chunk(f, hasher, chunk):
+        """写入一个数据块并更新哈希 (在线程中执行)"""
+        f.write(chunk)
+        if hasher is not None:
+            hasher.update(chunk)
+
+    @staticmethod
+    def _hash_prefix(path, hasher, length):
+        """把文件前 length 字节计入哈希 (在线程中执行)"""
+        with open(path, 'rb') as f:
+            while length > 0:
+                block = f.read(min(MERGE_BUFFER_SIZE, length))
+                if not block:
+                    break
+                hasher.update(block)
+                length -= len(block)
+
+    @classmethod
+    def _resume_from_checkpoint(cls, path, size, ckpt, hasher):
+        """校验检查点并把分片截断到该处，返回续传偏移；校验失败返回 -1 (在线程中执行)"""
+        # 检查点之前的数据已 fsync，之后的部分可能是崩溃时写坏的尾部，一律丢弃重下
+        offset = 0
+        if ckpt and size >= ckpt[0]:
+            cls._hash_prefix(path, hasher, ckpt[0])
+            if hasher.hexdigest() != ckpt[1]:
+                os.truncate(path, 0)
+                return -1
+            offset = ckpt[0]
+        if size != offset:
+            os.truncate(path, offset)
+        return offset
+
+    @staticmethod
+    def _sync_file(f):
+        """把缓冲区与页缓存写到磁盘 (在线程中执行)"""
+        f.flush()
+        os.fsync(f.fileno())
+
+    async def _part_writer(self, f, hasher, queue, part, part_index, written, expected_size, errors):
+        """分片写入任务: 从队列取数据写入文件 (None 为结束标记)"""
+        reported = written
+        checkpointed = written
+        inflight = None  # 正在线程中写入的块 (被取消时它是否已写入不确定)
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    return
+                inflight = chunk
+                await asyncio.to_thread(self._write_chunk, f, hasher, chunk)
+                inflight = None
+                written += len(chunk)
                 
-                f.write(chunk)
-                current_offset += len(chunk)
+                # 更新实时进度 (用于监控面板)，按粒度合并；接收端已截断，不会超过预期大小
+                if written - reported >= PROGRESS_UPDATE_BYTES or written >= expected_size:
+                    self._set_part_progress(part_index, written)
+                    reported = written
                 
-                # 更新实时进度 (用于监控面板)，限制不超过预期大小
-                self.active_parts[part_index] = min(current_offset, expected_size)
+                # 校验检查点: 先落盘再记录哈希，保证记录的前缀在崩溃后仍然完整
+                if hasher is not None and part is not None and (
+                        written - checkpointed >= CHECKPOINT_BYTES or written >= expected_size):
+                    await asyncio.to_thread(self._sync_file, f)
+                    part['ckpt'] = [written, hasher.hexdigest()]
+                    checkpointed = written
+                    if self.current_task is not None:
+                        self._save_task(self.current_task)
+        except Exception as e:
+            errors.append(e)
+            # 继续取出剩余数据，避免接收端阻塞在已满的队列上
+            while await queue.get() is not None:
+                pass
+        finally:
+            # 结束、出错或被取消时都上报已写入的字节数，进度快照不会少算未到粒度的部分
+            self._set_part_progress(part_index, written)
+            # 停止时补记一个检查点，续传不必丢弃最后一段 (有块写入状态不确定时跳过)
+            if hasher is not None and part is not None and inflight is None and written > checkpointed:
+                with suppress(Exception):
+                    await asyncio.to_thread(self._sync_file, f)
+                    part['ckpt'] = [written, hasher.hexdigest()]
+
+    @staticmethod
+    def _copy_part(infile, outfile):
+        """将分片内容写到输出文件的当前位置 (Linux 下走 copy_file_range / sendfile 内核零拷贝)"""
+        in_fd, out_fd = infile.fileno(), outfile.fileno()
+        if USE_COPY_FILE_RANGE:
+            remaining = os.fstat(in_fd).st_size
+            try:
+                # 同一文件系统上可能直接共享数据块 (reflink)，两端文件位置由内核推进
+                while remaining > 0:
+                    n = os.copy_file_range(in_fd, out_fd, remaining)
+                    if n == 0:
+                        break
+                    remaining -= n
+                return
+            except OSError as e:
+                # 跨文件系统或不支持时回退 (仅在尚未复制任何数据时)
+                if e.errno not in COPY_FALLBACK_ERRNOS or os.lseek(in_fd, 0, os.SEEK_CUR) != 0:
+                    raise
+        if USE_SENDFILE:
+            size = os.fstat(in_fd).st_size
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(out_fd, in_fd, offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        else:
+            # 每个合并线程复用同一块缓冲区 readinto，避免每次读取都分配新的 bytes
+            buf = getattr(_merge_local, 'buf', None)
+            if buf is None:
+                buf = _merge_local.buf = memoryview(bytearray(MERGE_BUFFER_SIZE))
+            while True:
+                n = infile.readinto(buf)
+                if not n:
+                    break
+                outfile.write(buf[:n])
+
+    @classmethod
+    def _copy_part_at(cls, part_path, file_path, offset):
+        """把单个分片写到最终文件的指定偏移 (在线程中执行，每个分片使用独立的文件描述符)"""
+        with open(part_path, 'rb') as infile, open(file_path, 'r+b') as outfile:
+            outfile.seek(offset)
+            cls._copy_part(infile, outfile)
+
+    @staticmethod
+    def _prepare_merge_target(task, temp_base_path, merge_path):
+        """创建合并临时文件，返回仍需复制进去的分片"""
+        # 临时目录与下载目录在同一文件系统时，直接把首个分片重命名为合并文件，
+        # 省去它的复制 (单分片文件完全不需要合并)；跨文件系统 (如 SSD 临时盘) 则回退到全量复制
+        remaining_parts = task.parts[1:]
+        mode = 'r+b'
+        try:
+            os.replace(f"{temp_base_path}.part{task.parts[0]['index']}", merge_path)
+        except FileNotFoundError:
+            # 上次合并中断: 首个分片已在合并文件开头 (其余分片不会写到它的区间)，重新写入其余分片即可
+            if not os.path.exists(merge_path):
+                raise
+        except OSError:
+            remaining_parts = task.parts
+            mode = 'wb'
+
+        with open(merge_path, mode) as outfile:
+            # 预分配合并文件，减少并发写入造成的碎片 (预分配后大小已等于完整文件，
+            # 所以只在临时文件上进行，全部写完重命名后最终文件的大小才可信)
+            if remaining_parts and hasattr(os, 'posix_fallocate') and task.file_size > 0:
+                try:
+                    os.posix_fallocate(outfile.fileno(), 0, task.file_size)
+                except OSError:
+                    pass
+        return remaining_parts
+
+    @staticmethod
+    def _remove_parts(temp_base_path, parts):
+        """删除临时分片文件 (忽略已不存在的)"""
+        for p in parts:
+            with suppress(OSError):
+                os.remove(f"{temp_base_path}.part{p['index']}")
 
     async def merge_parts(self, task, file_path):
         """合并分片"""
         logger.info(f"\n🔄 正在合并 {len(task.parts)} 个分片...")
         
         temp_base_path = os.path.join(Config.TEMP_DIR, task.file_name)
+        # 先写入临时文件，全部完成后再重命名，中断的合并不会留下大小正确但内容残缺的最终文件
+        merge_path = file_path + MERGE_TMP_SUFFIX
         
-        # 简单检查所有分片是否都在
+        # 简单检查所有分片是否都在 (上次合并中断时，首个分片已在合并临时文件中)
+        existing_parts, merging = await asyncio.to_thread(
+            lambda: (self._scan_part_sizes(task.file_name), os.path.exists(merge_path))
+        )
+        first_index = task.parts[0]['index']
         for p in task.parts:
-            part_path = f"{temp_base_path}.part{p['index']}"
-            if not os.path.exists(part_path):
-                logger.error(f"❌ 缺失分片文件: {part_path}")
+            if p['index'] not in existing_parts and not (merging and p['index'] == first_index):
+                logger.error(f"❌ 缺失分片文件: {temp_base_path}.part{p['index']}")
+                task.status = "error"
                 return
 
-        with open(file_path, 'wb') as outfile:
-            for p in task.parts:
-                part_path = f"{temp_base_path}.part{p['index']}"
-                with open(part_path, 'rb') as infile:
-                    while True:
-                        chunk = infile.read(4 * 1024 * 1024) # 4MB Buffer
-                        if not chunk: break
-                        outfile.write(chunk)
-                
-                # 删除临时分片
-                try: os.remove(part_path)
-                except: pass
+        # 准备最终文件 (重命名 / 创建 / 预分配都是阻塞调用，放到线程中)
+        remaining_parts = await asyncio.to_thread(self._prepare_merge_target, task, temp_base_path, merge_path)
+        
+        # 各分片区间互不重叠，按 start_offset 并发写入合并文件
+        semaphore = asyncio.Semaphore(MERGE_CONCURRENCY)
+        
+        async def copy_one(p):
+            part_path = f"{temp_base_path}.part{p['index']}"
+            async with semaphore:
+                await asyncio.to_thread(self._copy_part_at, part_path, merge_path, p['start_offset'])
+        
+        await asyncio.gather(*(copy_one(p) for p in remaining_parts))
+        
+        # 全部写完后才发布为最终文件，之后再删除分片 (中途中断可以重新合并)
+        await asyncio.to_thread(os.replace, merge_path, file_path)
+        
+        # 删除临时分片
+        await asyncio.to_thread(self._remove_parts, temp_base_path, remaining_parts)
         
         task.status = "completed"
-        self._save_task(task)
         
-        # 删除进度文件
-        try:
-            os.remove(Config.get_progress_file_path(task.message_id, task.chat_id))
-        except: pass
+        # 删除进度记录
+        await self._forget_task(task.chat_id, task.message_id)
         
         logger.info(f"✅ 下载完成: {task.file_name}")
         logger.info(f"📂 {file_path}")
@@ -612,7 +1080,7 @@ class TelethonDownloader:
                 msg = (
                     f"✅ **下载完成**\n\n"
                     f"📄 `{task.file_name}`\n"
-                    f"📂大小: {task.file_size/1024/1024:.2f} MB\n"
+                    f"📂大小: {task.file_size / MB:.2f} MB\n"
                     f"⏱耗时: {duration_str}"
                 )
                 await task.message.reply(msg)
@@ -622,24 +1090,35 @@ class TelethonDownloader:
             except Exception as e:
                 logger.error(f"❌ 发送通知失败: {e}")
 
-            # 添加到数据库历史记录
-            await database.add_history(task.file_name, task.file_size, duration_str)
+            # 记录历史 (队列清空时批量写入数据库)
+            self._pending_history.append((task.file_name, task.file_size, duration_str, datetime.now()))
             await asyncio.sleep(0.2)
 
     async def monitor_progress(self, task, num_parts, stop_event):
         """进度监控面板 (支持 Headless 模式)"""
         total_size = task.file_size
+        total_size_mb = total_size / MB
+        # 各分片预期大小只算一次
+        part_expected = [p['end_offset'] - p['start_offset'] + 1 for p in task.parts]
         last_bytes = 0
-        last_time = time.time()
+        last_time = time.monotonic()
         speed = 0
         
         # Headless 模式下，最后一次日志的时间
-        last_log_time = 0
+        last_log_time = float("-inf")
+        # 交互模式下上一次绘制的内容，以及分片行对应的状态版本
+        last_body = None
+        parts_rev = None
+        parts_head = ""
+        active_slots = []  # [(分片序号, 是否下载中)]，最多 MONITOR_MAX_ACTIVE 个
+        active_more = ""
+        # 输出不是终端 (docker logs / journald) 时 ANSI 面板没有意义，按 Headless 方式定时输出日志
+        headless = Config.HEADLESS or not sys.stdout.isatty()
         
         while not stop_event.is_set():
             # 1. 计算通用统计数据
-            total_downloaded = sum(self.active_parts.values())
-            now = time.time()
+            total_downloaded = self._total_downloaded
+            now = time.monotonic()
             elapsed = now - last_time
             
             # 计算瞬时速度
@@ -663,17 +1142,17 @@ class TelethonDownloader:
             self.current_eta = eta
             
             # 2. 分支处理：Headless vs Interactive
-            if Config.HEADLESS:
+            if headless:
                 # 定时日志 (避免刷屏)
                 if now - last_log_time >= Config.LOG_INTERVAL:
                     # 统计分片状态
-                    completed_count = sum(1 for s in self.part_status.values() if s == 'completed')
-                    downloading_count = sum(1 for s in self.part_status.values() if s == 'downloading')
+                    completed_count = self._status_counts['completed']
+                    downloading_count = self._status_counts['downloading']
                     
                     log_msg = (
                         f"📈 进度: {percent:5.1f}% | "
-                        f"📥 {total_downloaded/1024/1024:.1f}/{total_size/1024/1024:.1f} MB | "
-                        f"⚡ {speed/1024/1024:.2f} MB/s | "
+                        f"📥 {total_downloaded / MB:.1f}/{total_size_mb:.1f} MB | "
+                        f"⚡ {speed / MB:.2f} MB/s | "
                         f"分片: ✅{completed_count} ⬇️{downloading_count} | ETA: {eta}"
                     )
                     logger.info(log_msg)
@@ -684,62 +1163,61 @@ class TelethonDownloader:
                 
             else:
                 # === 原有的 ANSI 进度条逻辑 ===
-                # 统计各状态
-                completed = 0
-                downloading = 0
-                waiting = 0
-                pending = 0
-                downloading_list = []
+                # 状态计数与活跃分片列表只在分片状态变化后重建 (进度变化不会触发)
+                if parts_rev != self._state_rev:
+                    parts_rev = self._state_rev
+                    # 各状态计数由 _set_part_status 维护，这里只遍历活跃分片
+                    counts = self._status_counts
+                    completed = counts['completed']
+                    downloading = counts['downloading']
+                    waiting = counts['waiting']
+                    pending = num_parts - completed - downloading - waiting
+                    parts_head = f"  ✅{completed} ⬇️{downloading} ⏳{waiting} 📋{pending}  |  "
+                    active_slots = [
+                        (i, self.part_status[i] == 'downloading')
+                        for i in sorted(self._active_indices)[:MONITOR_MAX_ACTIVE]
+                    ]
+                    active_more = '...' if downloading + waiting > MONITOR_MAX_ACTIVE else ''
                 
-                for i in range(num_parts):
-                    status = self.part_status.get(i, 'pending')
-                    if status == 'completed':
-                        completed += 1
-                    elif status == 'downloading':
-                        downloading += 1
+                # 活跃分片（最多6个）的百分比每次刷新计算
+                active_items = []
+                for i, is_downloading in active_slots:
+                    if is_downloading:
                         current = self.active_parts.get(i, 0)
-                        p_data = task.parts[i]
-                        expected = p_data['end_offset'] - p_data['start_offset'] + 1
+                        expected = part_expected[i]
                         pct = min(100, (current / expected * 100)) if expected > 0 else 0
-                        downloading_list.append(f"P{i}:{pct:.0f}%")
-                    elif status == 'waiting':
-                        waiting += 1
-                        downloading_list.append(f"P{i}:⏳")
+                        active_items.append(f"P{i}:{pct:.0f}%")
                     else:
-                        pending += 1
+                        active_items.append(f"P{i}:⏳")
+                parts_line = parts_head + ' '.join(active_items) + active_more
                 
                 # 进度条
-                bar_len = 30
-                filled = int(bar_len * percent / 100)
-                bar = '█' * filled + '░' * (bar_len - filled)
-                
-                # 活跃分片（最多6个）
-                active_str = ' '.join(downloading_list[:6])
-                if len(downloading_list) > 6:
-                    active_str += '...'
+                filled = int(MONITOR_BAR_LEN * percent / 100)
+                bar = '█' * filled + '░' * (MONITOR_BAR_LEN - filled)
                 
-                lines = [
-                    f"{'═'*60}",
+                body = (
                     f"  [{bar}] {percent:5.1f}%",
-                    f"  📥 {total_downloaded/1024/1024:.1f}/{total_size/1024/1024:.1f} MB | ⚡ {speed/1024/1024:.2f} MB/s | ETA: {eta}",
-                    f"  ✅{completed} ⬇️{downloading} ⏳{waiting} 📋{pending}  |  {active_str}",
-                    f"{'═'*60}"
-                ]
-                
-                # 刷新显示 (移动光标逻辑)
-                LINES_COUNT = 5
-                monitor_attr_name = '_monitor_initialized'
-                
-                # 首次打印不移动光标
-                if not getattr(self, monitor_attr_name, False):
-                    setattr(self, monitor_attr_name, True)
-                else:
-                    print(f"\033[{LINES_COUNT}A", end="", flush=True)
+                    f"  📥 {total_downloaded / MB:.1f}/{total_size_mb:.1f} MB | ⚡ {speed / MB:.2f} MB/s | ETA: {eta}",
+                    parts_line,
+                )
                 
-                for line in lines:
-                    print(f"\033[2K\r{line}", flush=True)
+                # 内容未变化时不重绘
+                if body != last_body:
+                    last_body = body
+                    lines = (MONITOR_SEP,) + body + (MONITOR_SEP,)
                     
-                await asyncio.sleep(0.2)
+                    # 首次打印不移动光标
+                    if not getattr(self, '_monitor_initialized', False):
+                        self._monitor_initialized = True
+                        prefix = ""
+                    else:
+                        prefix = MONITOR_CURSOR_UP
+                    
+                    # 一次写入整个面板，只 flush 一次
+                    sys.stdout.write(prefix + "".join(f"\033[2K\r{line}\n" for line in lines))
+                    sys.stdout.flush()
+                    
+                await asyncio.sleep(Config.REFRESH_INTERVAL)
 
     def get_status_text(self):
         """获取当前状态文本 (供 Bot 命令使用)"""
@@ -755,8 +1233,8 @@ class TelethonDownloader:
             status_lines.append(f"\n🚀 正在下载:")
             status_lines.append(f"📄 {t.file_name}")
             status_lines.append(f"📊 进度: {self.current_percent:.1f}%")
-            status_lines.append(f"📥 大小: {t.file_size/1024/1024:.2f} MB")
-            status_lines.append(f"⚡ 速度: {self.current_speed/1024/1024:.2f} MB/s")
+            status_lines.append(f"📥 大小: {t.file_size / MB:.2f} MB")
+            status_lines.append(f"⚡ 速度: {self.current_speed / MB:.2f} MB/s")
             status_lines.append(f"⏱ 剩余: {self.current_eta}")
         else:
             status_lines.append("\n💤 当前无下载任务")
@@ -771,49 +1249,78 @@ class TelethonDownloader:
             return True
         return False
 
+    async def _import_legacy_progress(self):
+        """一次性迁移旧版 task_*.json 进度文件到数据库"""
+        # 只遍历一次目录，按名称过滤 (临时目录中可能有大量分片文件)；目录不存在时直接跳过
+        def list_legacy():
+            try:
+                it = os.scandir(Config.TEMP_DIR)
+            except FileNotFoundError:
+                return []
+            with it:
+                return [e.path for e in it
+                        if e.name.startswith("task_") and e.name.endswith(".json") and e.is_file()]
+
+        def read_json(path):
+            with open(path, 'rb') as f:
+                return json.loads(f.read())
+
+        for file in await asyncio.to_thread(list_legacy):
+            try:
+                data = await asyncio.to_thread(read_json, file)
+                if await database.save_active_task(data):
+                    await asyncio.to_thread(os.remove, file)
+                    logger.info(f"📦 已迁移旧进度文件: {os.path.basename(file)}")
+            except Exception as e:
+                logger.warning(f"⚠️ 迁移进度文件失败 {file}: {e}")
+
     async def restore_tasks(self):
-        """从临时文件恢复未完成的任务"""
-        if not Config.TEMP_DIR or not os.path.exists(Config.TEMP_DIR):
-            return
+        """从数据库恢复未完成的任务"""
+        await self._import_legacy_progress()
 
         logger.info("🔍 正在扫描未完成任务...")
         count = 0
-        import glob
         
-        files = glob.glob(os.path.join(Config.TEMP_DIR, "task_*.json"))
-        for file in files:
+        # 1. 解析任务记录，按会话分组
+        by_chat: Dict[int, List[DownloadTask]] = {}
+        for data in await database.list_active_tasks():
             try:
-                with open(file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                
                 # 过滤已完成或已取消的任务
                 if data.get('status') in ['completed', 'cancelled']:
                     continue
                 
                 # 恢复任务对象
                 task = DownloadTask.from_dict(data)
-                
-                # 获取原始消息对象 (必须，否则无法下载)
-                try:
-                    message = await self.client.get_messages(task.chat_id, ids=task.message_id)
-                    if not message or not message.media:
-                        logger.warning(f"⚠️ 无法恢复任务 {task.file_name}: 消息已失效")
-                        continue
-                    task.message = message
-                except Exception as e:
-                    logger.warning(f"⚠️ 无法获取消息 {task.message_id}: {e}")
+                by_chat.setdefault(task.chat_id, []).append(task)
+            except Exception as e:
+                logger.error(f"❌ 恢复任务失败 {data.get('file_name')}: {e}")
+        
+        # 2. 获取原始消息对象 (必须，否则无法下载)
+        # 每个会话一次批量请求，各会话并发进行
+        chats = list(by_chat.items())
+        results = await asyncio.gather(
+            *(self.client.get_messages(chat_id, ids=[t.message_id for t in tasks]) for chat_id, tasks in chats),
+            return_exceptions=True
+        )
+        
+        for (chat_id, tasks), messages in zip(chats, results):
+            if isinstance(messages, BaseException):
+                for task in tasks:
+                    logger.warning(f"⚠️ 无法获取消息 {task.message_id}: {messages}")
+                continue
+            
+            # 返回列表与 ids 一一对应 (不存在的消息为 None)
+            for task, message in zip(tasks, messages):
+                if not message or not message.media:
+                    logger.warning(f"⚠️ 无法恢复任务 {task.file_name}: 消息已失效")
                     continue
+                task.message = message
 
-                # 添加到队列
+                # 3. 添加到队列
                 # 避免重复
-                if not any(t.message_id == task.message_id for t in self.tasks) and \
-                   (not self.current_task or self.current_task.message_id != task.message_id):
-                    self.tasks.append(task)
+                if not self._is_running_task(task) and self._enqueue(task):
                     count += 1
                     logger.info(f"♻️ 已恢复任务: {task.file_name} ({task.status})")
-                    
-            except Exception as e:
-                logger.error(f"❌ 恢复任务失败 {file}: {e}")
         
         if count > 0:
             logger.info(f"✅ 成功恢复 {count} 个任务")
@@ -822,60 +1329,44 @@ class TelethonDownloader:
                 asyncio.create_task(self.process_queue())
 
     async def get_cancelled_tasks(self):
-        """获取所有已取消的任务列表"""
-        if not Config.TEMP_DIR or not os.path.exists(Config.TEMP_DIR):
-            return []
+        """获取所有已取消的任务列表 (按时间倒序，短时间内复用上次结果)"""
+        cached = self._cancelled_cache
+        if cached and time.monotonic() - cached[0] < self.CANCELLED_CACHE_TTL:
+            return cached[1]
+        async with self._cancelled_lock:
+            # 等待锁期间可能已被其他调用刷新
+            cached = self._cancelled_cache
+            if cached and time.monotonic() - cached[0] < self.CANCELLED_CACHE_TTL:
+                return cached[1]
+            cancelled_tasks = await self._load_cancelled_tasks()
+            self._cancelled_cache = (time.monotonic(), cancelled_tasks)
+            return cancelled_tasks
 
+    async def _load_cancelled_tasks(self):
+        """从数据库读取已取消任务的基本信息"""
         cancelled_tasks = []
-        import glob
-        files = glob.glob(os.path.join(Config.TEMP_DIR, "task_*.json"))
-        
-        for file in files:
+        for data in await database.list_active_tasks('cancelled'):
             try:
-                with open(file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                
-                if data.get('status') == 'cancelled':
-                    # 避免加载太多详细信息，只返回基本信息
-                    task_info = {
-                        "message_id": data['message_id'],
-                        "filename": data['file_name'],
-                        "size": data['file_size'],
-                        "updated_at": data.get('updated_at', ''),
-                        "progress": data.get('downloaded_bytes', 0) / data.get('file_size', 1) * 100
-                    }
-                    cancelled_tasks.append(task_info)
+                # 避免加载太多详细信息，只返回基本信息
+                task_info = {
+                    "message_id": data['message_id'],
+                    "filename": data['file_name'],
+                    "size": data['file_size'],
+                    "updated_at": data.get('updated_at', ''),
+                    "progress": data.get('downloaded_bytes', 0) / data.get('file_size', 1) * 100
+                }
+                cancelled_tasks.append(task_info)
             except:
                 pass
         
-        # 按时间倒序
-        cancelled_tasks.sort(key=lambda x: x['updated_at'], reverse=True)
         return cancelled_tasks
 
     async def delete_task(self, message_id):
         """彻底清除已取消任务及其临时文件"""
-        if not Config.TEMP_DIR or not os.path.exists(Config.TEMP_DIR):
-            return False
-
-        import glob
-        # 1. 找到对应的元数据文件
-        # 因为我们不知道 chat_id，所以需要扫描
-        target_file = None
-        task_data = None
-        
-        files = glob.glob(os.path.join(Config.TEMP_DIR, "task_*.json"))
-        for file in files:
-            try:
-                with open(file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                if str(data.get('message_id')) == str(message_id):
-                    target_file = file
-                    task_data = data
-                    break
-            except:
-                continue
+        # 1. 找到对应的任务记录 (不知道 chat_id，按 message_id 查找)
+        task_data = await database.find_active_task(int(message_id))
                 
-        if not target_file:
+        if not task_data:
             logger.warning(f"❌ 找不到需要删除的任务 ID: {message_id}")
             return False
             
@@ -883,54 +1374,29 @@ class TelethonDownloader:
         try:
             file_name = task_data.get('file_name')
             if file_name:
-                # 构造分片的基础路径
-                # 注意：这里需要与 download_part_worker 中的路径生成逻辑一致
-                # part_path = f"{temp_base_path}.part{p.index}"
-                # temp_base_path = os.path.join(Config.TEMP_DIR, task.file_name)
-                
-                # 使用 glob 匹配所有分片
-                # 注意转义文件名中的特殊字符用于 glob
-                escaped_name = glob.escape(file_name)
-                part_pattern = os.path.join(Config.TEMP_DIR, f"{escaped_name}.part*")
-                part_files = glob.glob(part_pattern)
-                
-                for pf in part_files:
-                    try:
-                        os.remove(pf)
-                    except OSError as e:
-                        logger.error(f"删除分片失败 {pf}: {e}")
+                # 一次目录遍历删除所有分片 (与 _scan_part_sizes 的命名规则一致)，在线程中进行
+                await asyncio.to_thread(self._delete_part_files, file_name)
                         
             logger.info(f"🗑️ 已清理任务文件: {file_name}")
         except Exception as e:
             logger.error(f"清理分片过程出错: {e}")
             
-        # 3. 删除元数据文件
-        try:
-            os.remove(target_file)
-            logger.info(f"✅ 任务记录已移除: {target_file}")
-            return True
-        except Exception as e:
-            logger.error(f"删除任务记录失败: {e}")
-            return False
-            return False
+        # 3. 删除任务记录 (丢弃尚未写出的进度，避免被后台写回)
+        await self._forget_task(task_data.get('chat_id'), task_data.get('message_id'))
+        logger.info(f"✅ 任务记录已移除: {message_id}")
+        return True
 
     async def resume_task(self, message_id):
         """恢复已取消的任务"""
         logger.info(f"♻️ 正在恢复任务 ID: {message_id}")
-        import glob
         
-        # 查找对应的任务文件 (因为不知道 chat_id，只能遍历)
-        # 或者假如我们知道 message_id 是唯一的
-        files = glob.glob(os.path.join(Config.TEMP_DIR, f"task_*_{message_id}.json"))
-        if not files:
-            logger.warning("❌ 找不到任务文件")
+        # 查找对应的任务记录 (不知道 chat_id，按 message_id 查找)
+        data = await database.find_active_task(int(message_id))
+        if not data:
+            logger.warning("❌ 找不到任务记录")
             return False
             
-        file_path = files[0]
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
             task = DownloadTask.from_dict(data)
             
             # 获取原始消息
@@ -949,16 +1415,14 @@ class TelethonDownloader:
             self._save_task(task)
             
             # 加入队列
-            for t in self.tasks:
-                if t.message_id == task.message_id:
-                    logger.info("⚠️ 任务已在队列中")
-                    return True
-                    
-            if self.current_task and self.current_task.message_id == task.message_id:
+            if self._is_running_task(task):
                  logger.info("⚠️ 任务正在运行")
                  return True
+                 
+            if not self._enqueue(task):
+                logger.info("⚠️ 任务已在队列中")
+                return True
 
-            self.tasks.append(task)
             logger.info(f"✅ 任务已恢复并加入队列: {task.file_name}")
             
             if not self.is_running:
@@ -5,10 +5,14 @@ Telegram Downloader (Telethon Version)
 """
 import asyncio
 import logging
-import os
+import re
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import python_socks
 from telethon import TelegramClient, events
 from config import Config
-from downloader import TelethonDownloader
+from downloader import TelethonDownloader, MERGE_CONCURRENCY
 
 # 配置日志（简化格式避免错误）
 logging.basicConfig(
@@ -19,11 +23,16 @@ logging.basicConfig(
 logger = logging.getLogger("Main")
 logging.getLogger('telethon').setLevel(logging.WARNING)
 
+# 消息链接: t.me/<用户名>/<消息ID> 或私有频道 t.me/c/<频道ID>/<消息ID> (telegram.me 同理)
+TG_LINK_RE = re.compile(r"(?:t|telegram)\.me/(?:c/(\d+)|([A-Za-z0-9_]+))/(\d+)")
+
 # ========== 全局变量（延迟初始化）==========
 client = None
 downloader = None
 client_connected = False
 event_handlers_registered = False
+# Telethon 代理元组缓存: (生成时的 Config.PROXY, 代理元组)，配置重载后 Config.PROXY 是新对象
+_proxy_cache = (None, None)
 
 # ========== Getter 函数供 Dashboard 调用 ==========
 def get_client():
@@ -36,14 +45,20 @@ def get_client_connected():
     return client_connected
 
 def get_telethon_proxy():
-    """获取 Telethon 格式的代理配置"""
+    """获取 Telethon 格式的代理配置 (配置未变化时复用上次结果)"""
+    global _proxy_cache
     if not Config.PROXY:
         return None
     
-    import python_socks
+    source, proxy = _proxy_cache
+    if source is Config.PROXY:
+        return proxy
+    
     scheme = Config.PROXY.get('scheme')
     proxy_type = python_socks.ProxyType.SOCKS5 if scheme == 'socks5' else python_socks.ProxyType.HTTP
-    return (proxy_type, Config.PROXY['hostname'], Config.PROXY['port'])
+    proxy = (proxy_type, Config.PROXY['hostname'], Config.PROXY['port'])
+    _proxy_cache = (Config.PROXY, proxy)
+    return proxy
 
 def create_client():
     """创建新的 Telegram Client（延迟初始化）"""
@@ -112,6 +127,20 @@ def ensure_client():
         create_client()
     return client
 
+# ========== Bot 指令 ==========
+async def cmd_ping(event):
+    await event.reply("🏓 Pong! Bot 运行正常")
+
+async def cmd_status(event):
+    status_info = downloader.get_status_text()
+    await event.reply(f"📊 下载状态:\n{status_info}")
+
+# 指令名 -> 处理函数 (新增指令只需在此注册)
+COMMANDS = {
+    '/ping': cmd_ping,
+    '/status': cmd_status,
+}
+
 async def message_handler(event):
     """消息处理器（收藏夹新消息）"""
     message = event.message
@@ -122,16 +151,12 @@ async def message_handler(event):
         cmd = message.text.strip().split()[0].lower()
         logger.info(f"🤖 收到指令: {cmd}")
         
-        if cmd == '/ping':
-            await event.reply("🏓 Pong! Bot 运行正常")
-            return
-        elif cmd == '/status':
-            status_info = downloader.get_status_summary()
-            await event.reply(f"📊 下载状态:\n{status_info}")
-            return
+        handler = COMMANDS.get(cmd)
+        if handler:
+            await handler(event)
         else:
             await event.reply(f"❓ 未知指令: {cmd}")
-            return
+        return
 
     # 处理转发的媒体
     if message.fwd_from and message.media:
@@ -143,26 +168,24 @@ async def message_handler(event):
         await downloader.add_task(message)
         return
 
-    # 处理链接
-    if message.text and ('t.me/' in message.text or 'telegram.me/' in message.text):
+    # 处理链接 (一次扫描取出所有消息链接)
+    links = TG_LINK_RE.findall(message.text) if message.text else None
+    if links:
         logger.info("🔗 检测到频道/消息链接")
-        urls = [word for word in message.text.split() if 't.me/' in word or 'telegram.me/' in word]
         
-        for url in urls:
+        for channel_id, channel_username, msg_id in links:
             try:
-                parts = url.split('/')
-                if len(parts) >= 2:
-                    channel_username = parts[-2]
-                    msg_id = int(parts[-1]) if parts[-1].isdigit() else None
-                    
-                    if msg_id:
-                        logger.info(f"📡 正在从 @{channel_username} 获取消息 {msg_id}")
-                        remote_msg = await client.get_messages(channel_username, ids=msg_id)
-                        
-                        if remote_msg and remote_msg.media:
-                            await downloader.add_task(remote_msg)
-                        else:
-                            logger.warning(f"⚠️ 消息 {msg_id} 无媒体内容")
+                # 私有频道链接中的 ID 需要加上 -100 前缀
+                entity = int(f"-100{channel_id}") if channel_id else channel_username
+                msg_id = int(msg_id)
+                
+                logger.info(f"📡 正在从 @{channel_username or channel_id} 获取消息 {msg_id}")
+                remote_msg = await client.get_messages(entity, ids=msg_id)
+                
+                if remote_msg and remote_msg.media:
+                    await downloader.add_task(remote_msg)
+                else:
+                    logger.warning(f"⚠️ 消息 {msg_id} 无媒体内容")
             except Exception as e:
                 logger.error(f"❌ 链接解析失败: {e}")
         return
@@ -223,11 +246,18 @@ async def start_telegram_bot():
 async def main():
     logger.info("🚀 Telegram 下载器 (Telethon版) 启动中...")
     
+    # 文件 IO 线程池: 分片写入 + 合并复制 + 扫描，全部通过 asyncio.to_thread 提交到这里
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(
+        max_workers=max(8, Config.MAX_WORKERS + MERGE_CONCURRENCY),
+        thread_name_prefix="tg-io"
+    ))
+    
     # 初始化数据库
     import database
     await database.init_db()
 
     # 无条件启动 Dashboard
+    dashboard_task = None
     if Config.ENABLE_DASHBOARD:
         try:
             from dashboard import server
@@ -235,7 +265,7 @@ async def main():
             import __main__
             server.main_module = __main__
             
-            asyncio.create_task(server.run_server())
+            dashboard_task = asyncio.create_task(server.run_server())
             logger.info("🌐 Dashboard 服务已启动")
             logger.info(f"🌐 访问地址: http://{Config.DASHBOARD_HOST}:{Config.DASHBOARD_PORT}")
         except ImportError as e:
@@ -244,7 +274,7 @@ async def main():
             logger.error(f"❌ Dashboard 启动出错: {e}")
     
     # 检查应用状态
-    session_exists = os.path.exists(f"{Config.SESSION_NAME}.session")
+    session_exists = Config.session_exists()
     
     if not Config.SETUP_COMPLETED:
         logger.info("📋 首次启动检测到，请访问 Dashboard 完成初始化")
@@ -257,11 +287,42 @@ async def main():
         logger.info("🤖 检测到 Session，正在启动 Telegram Bot...")
         asyncio.create_task(start_telegram_bot())
     
-    # 保持事件循环运行
+    # 保持事件循环运行，直到收到退出信号
+    # 非 Windows 平台由事件循环直接处理 SIGINT / SIGTERM (docker stop、systemctl stop)，
+    # 退出前保存下载进度；Windows 上 Ctrl+C 仍以 KeyboardInterrupt 取消主任务，同样走 finally
+    stop_event = asyncio.Event()
+    if sys.platform != 'win32':
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+    
     logger.info("⏳ 主程序运行中，按 Ctrl+C 退出")
-    await asyncio.Event().wait()
+    try:
+        await stop_event.wait()
+        logger.info("👋 收到退出信号，正在关闭...")
+    finally:
+        if dashboard_task is not None and not dashboard_task.done():
+            server.stop_server()
+            try:
+                await asyncio.wait_for(dashboard_task, timeout=5)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                pass
+        if client is not None:
+            await destroy_client()
+        await database.close_db()
+
+def install_uvloop():
+    """非 Windows 平台启用 uvloop 事件循环 (未安装时沿用默认循环)"""
+    if sys.platform == 'win32':
+        return
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
 
 if __name__ == "__main__":
+    install_uvloop()
     try:
         asyncio.run(main())
     except KeyboardInterrupt: